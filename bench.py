@@ -0,0 +1,341 @@
+"""Нагрузочный бенчмарк cr.py без Telegram и внешних API.
+
+Поднимает локальные заглушки CoinGecko / ExchangeRate-API (с задержкой и
+ошибками), подменяет сессию бота на заглушку и прогоняет синтетические апдейты
+через dp.feed_update. Результат — апдейты/сек, перцентили задержки, записи в БД
+и обращения к внешним API на апдейт; --json для сравнения между коммитами.
+
+    python bench.py --updates 5000 --concurrency 100 --upstream-latency 80 --error-rate 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import GetMe
+from aiogram.types import Update, User
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ============== ЗАГЛУШКИ API ==============
+class UpstreamStub:
+    """CoinGecko и ExchangeRate-API на localhost с настраиваемой задержкой и долей ошибок"""
+
+    def __init__(self, latency: float, error_rate: float, rng: random.Random, primary_down: bool = False):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.primary_down = primary_down
+        self.rng = rng
+        self.calls: Counter = Counter()
+        self.errors = 0
+        self.catalog: list[dict] = []
+        self.rates: dict[str, float] = {}
+
+    def configure(self, crypto_ids: dict, fiat: list[str]):
+        """Каталог монет и курсы: поддерживаемые ботом плюс хвост, чтобы поиску было что перебирать"""
+        self.catalog = [{"id": coin_id, "symbol": symbol, "name": coin_id.title()}
+                        for symbol, coin_id in crypto_ids.items()]
+        self.catalog += [{"id": f"coin-{i}", "symbol": f"c{i}", "name": f"Coin {i}"} for i in range(2000)]
+        self.rates = {code: 1.0 if code == "USD" else round(self.rng.uniform(0.5, 150), 4) for code in fiat}
+        self.rates.update({f"X{i:02d}": float(i + 1) for i in range(50)})
+
+    async def _delay(self, endpoint: str, primary: bool = True) -> bool:
+        """Подождать и решить, отвечать ли ошибкой"""
+        self.calls[endpoint] += 1
+        if primary and self.primary_down:
+            self.errors += 1
+            return False
+        if self.latency:
+            await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            return False
+        return True
+
+    def _price(self, coin_id: str) -> float:
+        # Стабильная «цена» по id, чуть гуляющая между запросами
+        base = (sum(map(ord, coin_id)) % 1000 + 1) * 10.0
+        return base * self.rng.uniform(0.99, 1.01)
+
+    async def simple_price(self, request: web.Request) -> web.Response:
+        if not await self._delay("simple/price"):
+            return web.Response(status=429)
+        ids = [i for i in request.query.get("ids", "").split(",") if i]
+        data = {}
+        for coin_id in ids:
+            usd = self._price(coin_id)
+            data[coin_id] = {"usd": usd, "rub": usd * 90, "eur": usd * 0.92,
+                             "usd_24h_change": self.rng.uniform(-5, 5)}
+        return web.json_response(data)
+
+    async def coins_list(self, request: web.Request) -> web.Response:
+        if not await self._delay("coins/list"):
+            return web.Response(status=500)
+        return web.json_response(self.catalog)
+
+    async def coins_markets(self, request: web.Request) -> web.Response:
+        if not await self._delay("coins/markets"):
+            return web.Response(status=500)
+        page = int(request.query.get("page", "1"))
+        chunk = self.catalog[(page - 1) * 250:page * 250]
+        return web.json_response([
+            {"id": coin["id"], "market_cap_rank": (page - 1) * 250 + i + 1} for i, coin in enumerate(chunk)
+        ])
+
+    async def latest_usd(self, request: web.Request) -> web.Response:
+        if not await self._delay("latest/USD"):
+            return web.Response(status=500)
+        return web.json_response({"base": "USD", "rates": self.rates})
+
+    async def cryptocompare_price(self, request: web.Request) -> web.Response:
+        # Запасной источник крипты: ответ в формате CryptoCompare pricemultifull
+        if not await self._delay("pricemultifull", primary=False):
+            return web.Response(status=500)
+        raw = {}
+        for symbol in request.query.get("fsyms", "").split(","):
+            usd = self._price(symbol.lower())
+            change = self.rng.uniform(-5, 5)
+            raw[symbol] = {
+                "USD": {"PRICE": usd, "CHANGEPCT24HOUR": change},
+                "RUB": {"PRICE": usd * 90},
+                "EUR": {"PRICE": usd * 0.92},
+            }
+        return web.json_response({"RAW": raw})
+
+    async def open_er_latest(self, request: web.Request) -> web.Response:
+        # Запасной источник фиата: формат open.er-api.com
+        if not await self._delay("open-er/latest", primary=False):
+            return web.Response(status=500)
+        return web.json_response({"result": "success", "base_code": "USD", "rates": self.rates})
+
+    async def start(self) -> tuple[web.AppRunner, int]:
+        app = web.Application()
+        app.router.add_get("/api/v3/simple/price", self.simple_price)
+        app.router.add_get("/api/v3/coins/list", self.coins_list)
+        app.router.add_get("/api/v3/coins/markets", self.coins_markets)
+        app.router.add_get("/v4/latest/USD", self.latest_usd)
+        app.router.add_get("/data/pricemultifull", self.cryptocompare_price)
+        app.router.add_get("/v6/latest/USD", self.open_er_latest)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return runner, site._server.sockets[0].getsockname()[1]
+
+# ============== ЗАГЛУШКА BOT API ==============
+class StubSession(BaseSession):
+    """Сессия бота без сети: считает вызовы по методам, getMe отдаёт фейкового бота"""
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, GetMe):
+            return User(id=1, is_bot=True, first_name="Bench", username="bench_bot")
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+# ============== СИНТЕТИЧЕСКИЕ АПДЕЙТЫ ==============
+MESSAGES = ["BTC", "eth", "USD", "EUR", "/rate SOL", "/rate UAH", "/convert 0.5 BTC UAH",
+            "/history BTC 1d", "/start", "/help"]
+CALLBACKS = ["crypto_btc", "crypto_eth", "fiat_USD", "fiat_EUR", "menu_crypto", "menu_fiat", "menu_main"]
+INLINE = ["btc", "eth", "bit", "sol", "usd", "0.5 btc uah", "c12"]
+
+def make_update(update_id: int, kind: str, user_id: int, rng: random.Random) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    chat = {"id": user_id, "type": "private"}
+    if kind == "message":
+        return {"update_id": update_id, "message": {
+            "message_id": update_id, "date": 0, "chat": chat, "from": user, "text": rng.choice(MESSAGES)
+        }}
+    if kind == "callback":
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": user, "chat_instance": str(user_id), "data": rng.choice(CALLBACKS),
+            "message": {"message_id": update_id, "date": 0, "chat": chat, "text": "…"}
+        }}
+    return {"update_id": update_id, "inline_query": {
+        "id": str(update_id), "from": user, "query": rng.choice(INLINE), "offset": ""
+    }}
+
+# ============== ПРОГОН ==============
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]) * 1000
+    return {"count": len(values), "p50_ms": round(p50, 2), "p95_ms": round(p95, 2),
+            "p99_ms": round(p99, 2), "max_ms": round(max(values) * 1000, 2)}
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    upstream = UpstreamStub(args.upstream_latency / 1000, args.error_rate, rng, args.primary_down)
+
+    # cr.py читает конфиг из окружения при импорте; БД и файлы — во временном каталоге
+    workdir = tempfile.mkdtemp(prefix="crbench_")
+    os.chdir(workdir)
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+    os.environ["METRICS_PORT"] = "0"
+    sys.path.insert(0, REPO_DIR)
+
+    # cr берёт адреса API из окружения при импорте, а данные заглушки — из cr
+    upstream_runner, port = await upstream.start()
+    os.environ["CRYPTO_API"] = f"http://127.0.0.1:{port}/api/v3"
+    os.environ["FIAT_API"] = f"http://127.0.0.1:{port}/v4/latest/USD"
+    os.environ["CRYPTOCOMPARE_API"] = f"http://127.0.0.1:{port}/data"
+    os.environ["OPEN_ER_API"] = f"http://127.0.0.1:{port}/v6/latest/USD"
+    import cr
+    upstream.configure(cr.CRYPTO_IDS, cr.FIAT_CURRENCIES)
+
+    session = StubSession(args.api_latency / 1000)
+    for middleware in cr.bot.session.middleware:
+        session.middleware(middleware)
+    cr.bot.session = session
+    if args.no_throttle:
+        cr.throttling.limits = {}
+
+    await cr.on_startup()
+    if not args.cold:
+        # Тёплый старт: ждём первый снапшот цен и каталог
+        deadline = time.monotonic() + 30
+        while (cr.get_snapshot().version == 0 or not cr.coin_catalog.updated_at) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    kinds = [k for k, share in (("message", args.messages), ("callback", args.callbacks), ("inline", args.inline))
+             for _ in range(share)]
+    updates = [
+        (kind, Update.model_validate(make_update(i + 1, kind, 1000 + i % args.users, rng),
+                                     context={"bot": cr.bot}))
+        for i, kind in enumerate(rng.choice(kinds) for _ in range(args.updates))
+    ]
+
+    upstream_before = sum(upstream.calls.values())
+    api_before = sum(session.calls.values())
+    writer = cr.metrics.histograms.get(("bot_db_wait_seconds", (("conn", "writer"),)))
+    writes_before = writer.count if writer else 0
+    latencies = defaultdict(list)
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def feed(kind: str, update: Update):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await cr.dp.feed_update(cr.bot, update)
+            except Exception:
+                errors += 1
+            latencies[kind].append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(kind, update) for kind, update in updates))
+    elapsed = time.perf_counter() - started
+    upstream_calls = sum(upstream.calls.values()) - upstream_before
+    api_calls = sum(session.calls.values()) - api_before
+
+    # Дописываем лог запросов, чтобы посчитать все записи, вызванные прогоном
+    await cr.on_shutdown()
+    writer = cr.metrics.histograms.get(("bot_db_wait_seconds", (("conn", "writer"),)))
+    db_writes = (writer.count if writer else 0) - writes_before
+    await upstream_runner.cleanup()
+    os.chdir(REPO_DIR)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    all_latencies = [v for values in latencies.values() for v in values]
+    return {
+        "updates": args.updates,
+        "concurrency": args.concurrency,
+        "upstream_latency_ms": args.upstream_latency,
+        "error_rate": args.error_rate,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(args.updates / elapsed, 1),
+        "handler_errors": errors,
+        "latency": percentiles(all_latencies),
+        "latency_by_kind": {kind: percentiles(values) for kind, values in sorted(latencies.items())},
+        "db_write_transactions": db_writes,
+        "db_write_transactions_per_s": round(db_writes / elapsed, 1),
+        "request_log_rows": cr.request_log.written,
+        "upstream_calls": upstream_calls,
+        "upstream_calls_per_update": round(upstream_calls / args.updates, 4),
+        "upstream_errors": upstream.errors,
+        "upstream_calls_by_endpoint": dict(upstream.calls),
+        "providers": {
+            name: {
+                "up": provider.available(),
+                "hedge_delay_ms": round(provider.hedge_delay() * 1000, 1),
+                **{result: int(cr.metrics.counters.get(
+                    ("bot_provider_requests_total", (("provider", name), ("result", result))), 0))
+                   for result in ("ok", "error", "timeout")},
+            }
+            for name, provider in cr.PROVIDERS.items()
+        },
+        "bot_api_calls_per_update": round(api_calls / args.updates, 3),
+        "bot_api_calls": dict(session.calls),
+        "throttled": cr.throttling.rejected,
+    }
+
+def print_report(result: dict):
+    print(f"Апдейтов: {result['updates']} за {result['elapsed_s']} с, "
+          f"параллельно {result['concurrency']} → {result['updates_per_s']} апд/с")
+    print(f"Внешние API: задержка {result['upstream_latency_ms']} мс, ошибок {result['error_rate']:.0%}")
+    print()
+    print(f"{'тип':<10}{'count':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'max мс':>10}")
+    rows = list(result["latency_by_kind"].items()) + [("всего", result["latency"])]
+    for kind, stats in rows:
+        print(f"{kind:<10}{stats['count']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+    print()
+    print(f"Транзакций записи в БД: {result['db_write_transactions']} "
+          f"({result['db_write_transactions_per_s']}/с), строк лога: {result['request_log_rows']}")
+    print(f"Запросов к внешним API: {result['upstream_calls']} "
+          f"({result['upstream_calls_per_update']} на апдейт), ошибок: {result['upstream_errors']}")
+    print(f"По эндпоинтам: {result['upstream_calls_by_endpoint']}")
+    for name, stats in result["providers"].items():
+        print(f"  {name}: {stats}")
+    print(f"Вызовов Bot API на апдейт: {result['bot_api_calls_per_update']} {result['bot_api_calls']}")
+    print(f"Ошибок в хендлерах: {result['handler_errors']}, отклонено антифлудом: {result['throttled']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк cr.py на синтетических апдейтах")
+    parser.add_argument("--updates", type=int, default=2000, help="сколько апдейтов прогнать")
+    parser.add_argument("--concurrency", type=int, default=50, help="апдейтов в обработке одновременно")
+    parser.add_argument("--users", type=int, default=1000, help="разных юзеров в апдейтах")
+    parser.add_argument("--messages", type=int, default=5, help="доля сообщений в смеси")
+    parser.add_argument("--callbacks", type=int, default=3, help="доля нажатий кнопок в смеси")
+    parser.add_argument("--inline", type=int, default=2, help="доля инлайн-запросов в смеси")
+    parser.add_argument("--upstream-latency", type=float, default=50, help="мс, задержка заглушек API")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов заглушек с ошибкой")
+    parser.add_argument("--primary-down", action="store_true",
+                        help="основные источники (CoinGecko, ExchangeRate-API) всегда отвечают ошибкой")
+    parser.add_argument("--api-latency", type=float, default=0, help="мс, задержка заглушки Bot API")
+    parser.add_argument("--cold", action="store_true", help="не ждать первого снапшота цен")
+    parser.add_argument("--no-throttle", action="store_true", help="выключить антифлуд")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+
+if __name__ == "__main__":
+    main()
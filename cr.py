@@ -1,24 +1,87 @@
+import argparse
 import asyncio
+import array
+import bisect
+import csv
+import functools
+import gzip
+import heapq
+import io
+import json
 import logging
-from datetime import datetime
-from aiogram import Bot, Dispatcher, Router, F
+import mmap
+import multiprocessing
+import os
+import random
+import re
+import signal
+import struct
+import tempfile
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from types import MappingProxyType
+from typing import Mapping, NamedTuple, Optional
+from urllib.parse import urlsplit
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F
 from aiogram.types import (
-    Message, CallbackQuery, InlineQuery, InlineQueryResultArticle,
+    Update, Message, CallbackQuery, InlineQuery, InlineQueryResultArticle,
     InputTextMessageContent, InlineKeyboardMarkup, InlineKeyboardButton,
-    BufferedInputFile
+    InputFile
 )
 from aiogram.filters import Command, CommandStart
 from aiogram.enums import ParseMode
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter,
+    TelegramServerError
+)
 import aiohttp
+from aiohttp import web
 import aiosqlite
+import numpy as np
 
 # ============== КОНФИГ ==============
-BOT_TOKEN = ""
+BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 ADMIN_IDS = []  # ID админов
 
+# Режим запуска: "polling" или "webhook" (переопределяется флагом --mode)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# Webhook: встроенный aiohttp сервер
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")        # публичный https URL; пусто — setWebhook не вызываем
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "100"))  # апдейтов в обработке
+WEBHOOK_MAX_BACKLOG = int(os.getenv("WEBHOOK_MAX_BACKLOG", "1000"))  # принятых апдейтов, дальше — 503
+WEBHOOK_DRAIN_TIMEOUT = 30                        # сек ждём незавершённые апдейты при остановке
+
+# Многопроцессный режим (только с webhook): N воркеров + один процесс-загрузчик цен
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "0"))  # 0 — один процесс (переопределяется --workers)
+SHARED_SNAPSHOT_PATH = os.getenv("SHARED_SNAPSHOT_PATH", "prices.snapshot")
+WORKER_SYNC_INTERVAL = 5                          # сек, как часто воркер подтягивает баны и каталог
+
 # API URLs
-CRYPTO_API = "https://api.coingecko.com/api/v3"
-FIAT_API = "https://api.exchangerate-api.com/v4/latest/USD"
+# Переопределяются через окружение (например, на локальные заглушки в bench.py)
+CRYPTO_API = os.getenv("CRYPTO_API", "https://api.coingecko.com/api/v3")
+FIAT_API = os.getenv("FIAT_API", "https://api.exchangerate-api.com/v4/latest/USD")
+CRYPTOCOMPARE_API = os.getenv("CRYPTOCOMPARE_API", "https://min-api.cryptocompare.com/data")
+CRYPTOCOMPARE_FSYMS_MAX = 300  # символов в параметре fsyms, длиннее — несколько запросов
+OPEN_ER_API = os.getenv("OPEN_ER_API", "https://open.er-api.com/v6/latest/USD")
+
+# Источники цен по приоритету: первый основной, остальные — запасные
+CRYPTO_PROVIDERS = ["coingecko", "cryptocompare"]
+FIAT_PROVIDERS = ["exchangerate-api", "open-er-api"]
+PROVIDER_TIMEOUT = 5.0          # сек, бюджет задержки источника (по умолчанию)
+PROVIDER_TIMEOUTS = {}          # переопределения по имени источника
+BREAKER_FAILURES = 5            # ошибок подряд, после которых источник выключается
+BREAKER_COOLDOWN = 60           # сек до пробного запроса к выключенному источнику
+HEDGE_WINDOW = 200              # последних задержек для оценки p95
+HEDGE_MIN_SAMPLES = 20          # пока замеров меньше — ждём HEDGE_DEFAULT_DELAY
+HEDGE_DEFAULT_DELAY = 1.0       # сек
+HEDGE_MIN_DELAY = 0.05          # сек, раньше запасной не дёргаем
 
 # Популярные криптовалюты
 CRYPTO_IDS = {
@@ -37,27 +100,345 @@ CRYPTO_IDS = {
 # Популярные фиатные валюты
 FIAT_CURRENCIES = ["USD", "EUR", "RUB", "UAH", "GBP", "CNY", "JPY", "KZT", "BYN", "PLN"]
 
+# HTTP клиент (одна сессия на всё время работы)
+HTTP_TOTAL_TIMEOUT = 10      # сек на весь запрос
+HTTP_CONNECT_TIMEOUT = 3     # сек на установку соединения
+HTTP_LIMIT = 100             # всего соединений в пуле
+HTTP_LIMIT_PER_HOST = 20     # соединений на один хост
+HTTP_DNS_TTL = 300           # сек кэша DNS
+HTTP_KEEPALIVE = 30          # сек держим idle соединение
+
+# getMe при старте: старт его не ждёт, при ошибке повторяем с растущей паузой
+BOT_USERNAME_RETRY = 5       # сек
+BOT_USERNAME_MAX_RETRY = 300 # сек
+
+# Кэш цен: свежие данные отдаём из кэша, устаревшие — пока обновляем в фоне
+CRYPTO_CACHE_TTL = 30        # сек
+CRYPTO_CACHE_STALE = 300     # сек после TTL, когда ещё можно отдать старое
+FIAT_CACHE_TTL = 600
+FIAT_CACHE_STALE = 3600
+PRICE_CACHE_MAX_KEYS = 1024
+
+# Карточки цен по кнопкам: готовый текст и клавиатура на версию снапшота
+RENDER_CACHE_MAX_KEYS = 512          # карточек на одну версию снапшота
+RENDER_MESSAGES_MAX_KEYS = 20_000    # сообщений, для которых помним показанную карточку
+REFRESH_DEBOUNCE = 1.5               # сек, повторное «🔄 Обновить» того же сообщения гасим
+
+# Фоновое обновление снапшота цен
+PRICE_REFRESH_INTERVAL = 30      # сек между обновлениями крипты
+FIAT_REFRESH_INTERVAL = 600      # сек между обновлениями фиата
+PRICE_REFRESH_JITTER = 0.1       # ±10% к интервалу
+PRICE_REFRESH_MAX_BACKOFF = 300  # сек, потолок паузы при ошибках
+PRICE_SNAPSHOT_MAX_AGE = 600     # сек, старше — хендлеры идут через кэш
+FIAT_SNAPSHOT_MAX_AGE = 1800     # сек, то же для курсов фиата (обновляются реже)
+PRICE_SNAPSHOT_PATH = "prices.json"        # снапшот на диске для тёплого старта
+PRICE_SNAPSHOT_SAVE_INTERVAL = 300         # сек между сохранениями (и при остановке)
+PRICE_SNAPSHOT_RESTORE_MAX_AGE = 6 * 3600  # сек, более старый снапшот с диска не поднимаем
+
+# Каталог монет CoinGecko (поиск по любым тикерам)
+COINS_CATALOG_PATH = "coins.json"
+COINS_CATALOG_REFRESH = 24 * 3600  # сек между загрузками /coins/list
+COINS_MARKET_PAGES = 4             # страниц /coins/markets по 250 — ранг по капитализации
+INLINE_MAX_RESULTS = 10
+INLINE_SNAPSHOT_TOP = 150          # монет в снапшоте цен: CRYPTO_IDS + топ каталога по капитализации
+INLINE_FETCH_BUDGET = 0.3          # сек ждём цены монет не из снапшота, дальше показываем без цены
+
+# История цен: минутные точки -> часовые -> дневные
+HISTORY_RAW_KEEP = 2 * 86400         # сек храним минутные точки
+HISTORY_HOURLY_KEEP = 90 * 86400     # сек храним часовые, старше — только дневные
+HISTORY_FLUSH_INTERVAL = 60          # сек между записью открытых чанков в БД
+HISTORY_COMPACT_INTERVAL = 3600      # сек между прореживанием
+HISTORY_MAX_PERIOD = 5 * 365 * 86400
+HISTORY_SPARK_POINTS = 24
+
+# Исходящие сообщения (лимиты Telegram: ~30 в секунду всего, 1 в секунду в чат)
+SEND_GLOBAL_RATE = 25                # сообщений в секунду на всего бота
+SEND_CHAT_INTERVAL = 1.0             # сек между сообщениями в один чат
+SEND_MAX_ATTEMPTS = 3                # попыток на сообщение (RetryAfter, сетевые ошибки)
+
+# Рассылки
+BROADCAST_PAGE_SIZE = 100            # юзеров за шаг; после шага — чекпоинт в БД
+BROADCAST_PROGRESS_INTERVAL = 5      # сек между обновлениями прогресса у админа
+BROADCAST_SYNC_INTERVAL = 5          # сек, загрузчик подхватывает рассылки, запущенные из воркеров
+
+# Антифлуд: (запросов в секунду, запас) на юзера и тип апдейта; None — без лимита
+THROTTLE_LIMITS = {
+    "message": (1.0, 5),
+    "callback_query": (2.0, 6),
+    "inline_query": (3.0, 10),   # инлайн шлёт запрос на каждую букву
+}
+THROTTLE_MAX_KEYS = 50_000           # корзин в памяти максимум, старые вытесняются
+THROTTLE_IDLE_TTL = 600              # сек, корзина без активности удаляется
+THROTTLE_BAN_STRIKES = 30            # отказов за окно, после которых временный бан (0 — не банить)
+THROTTLE_STRIKE_WINDOW = 60          # сек
+THROTTLE_BAN_DURATION = 600          # сек
+
+# Алерты по цене
+ALERTS_PER_USER = 20
+ALERT_SYNC_INTERVAL = 10             # сек, загрузчик подтягивает алерты, созданные воркерами
+ALERT_SHUTDOWN_TIMEOUT = 15          # сек ждём отправки сработавших алертов при остановке
+
+# SQLite
+DB_READERS = 4                   # соединений на чтение
+DB_CACHE_SIZE_KB = 16384         # page cache на соединение
+DB_MMAP_SIZE = 64 * 1024 * 1024  # байт
+DB_CACHED_STATEMENTS = 256       # подготовленных запросов на соединение
+DB_BUSY_TIMEOUT = 5000           # мс
+
+# Лог запросов пишется пачками в фоне
+LOG_QUEUE_SIZE = 10000           # записей в очереди максимум
+LOG_BATCH_SIZE = 500             # записей в одной транзакции
+LOG_FLUSH_INTERVAL = 1.0         # сек, не дольше ждём набора пачки
+LOG_QUEUE_POLICY = "drop"        # при переполнении: "drop" — терять запись, "block" — ждать места
+
+# Обслуживание лога: сырые строки живут REQUEST_LOG_RETENTION_DAYS, дальше остаются только агрегаты
+REQUEST_LOG_RETENTION_DAYS = 30
+REQUEST_ROLLUP_RETENTION_DAYS = 90
+REQUEST_MAINTENANCE_INTERVAL = 300   # сек между проходами
+REQUEST_ROLLUP_BATCH = 50_000        # строк лога на одну транзакцию агрегации
+REQUEST_DELETE_BATCH = 2000          # строк на одну транзакцию удаления — писатель занят недолго
+INCREMENTAL_VACUUM_PAGES = 2000      # страниц возвращаем ОС за проход
+TOP_SYMBOLS_LIMIT = 10
+
+# Список юзеров в админке
+ADMIN_USERS_PAGE_SIZE = 20
+ADMIN_USERS_COUNT_TTL = 30       # сек кэшируем количество юзеров по фильтру
+
+# Выгрузки из админки
+EXPORT_CHUNK_ROWS = 1000                # строк читаем из БД за раз
+EXPORT_SPOOL_MAX = 8 * 1024 * 1024      # байт держим в памяти, дальше — временный файл на диске
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # 0 — не поднимать; воркер N слушает METRICS_PORT + 1 + N
+
 # ============== ИНИЦИАЛИЗАЦИЯ ==============
 logging.basicConfig(level=logging.INFO)
 bot = Bot(token=BOT_TOKEN)
+bot_username = "имя_бота"  # заглушка, пока getMe не ответил (запрашивается в фоне при старте)
 dp = Dispatcher()
 router = Router()
 dp.include_router(router)
 
 DB_PATH = "crypto.db"
 
+# ============== МЕТРИКИ ==============
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Счётчики по фиксированным корзинам: observe — бинпоиск и два сложения"""
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля интерполяцией внутри корзины, как histogram_quantile в Prometheus"""
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = LATENCY_BUCKETS[i - 1] if i else 0.0
+                if i == len(LATENCY_BUCKETS):
+                    return lower
+                return lower + (LATENCY_BUCKETS[i] - lower) * (rank - seen) / count
+            seen += count
+        return 0.0
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+class Metrics:
+    """Счётчики и гистограммы процесса; метки — кортеж пар (имя, значение)"""
+
+    def __init__(self):
+        self.counters: dict[tuple, float] = {}
+        self.histograms: dict[tuple, Histogram] = {}
+        self.collectors: list[tuple] = []   # (имя, тип, функция) — значения, которые уже считают другие объекты
+        self.help: dict[str, str] = {}
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram()
+        histogram.observe(value)
+
+    def collect(self, name: str, kind: str, fn, help: str = ""):
+        """fn() возвращает число или {метки: число}; вызывается только при выгрузке"""
+        self.collectors.append((name, kind, fn))
+        if help:
+            self.help[name] = help
+
+    def describe(self, name: str, help: str):
+        self.help[name] = help
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus"""
+        families: dict[str, tuple[str, list]] = {}
+        for (name, labels), value in self.counters.items():
+            families.setdefault(name, ("counter", []))[1].append((labels, value))
+        for name, kind, fn in self.collectors:
+            value = fn()
+            samples = value.items() if isinstance(value, dict) else [((), value)]
+            families.setdefault(name, (kind, []))[1].extend(samples)
+        for (name, labels), histogram in self.histograms.items():
+            samples = families.setdefault(name, ("histogram", []))[1]
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                samples.append((f"{name}_bucket", labels + (("le", bound),), cumulative))
+            samples.append((f"{name}_sum", labels, histogram.sum))
+            samples.append((f"{name}_count", labels, histogram.count))
+        
+        lines = []
+        for name, (kind, samples) in sorted(families.items()):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample in samples:
+                sample_name, labels, value = sample if len(sample) == 3 else (name, *sample)
+                lines.append(f"{sample_name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, name: str, limit: int = 8) -> list[tuple]:
+        """(значение первой метки, count, p50, p95, p99) по самым частым"""
+        rows = [
+            (labels[0][1] if labels else "", h.count, h.quantile(0.5), h.quantile(0.95), h.quantile(0.99))
+            for (metric, labels), h in self.histograms.items() if metric == name and h.count
+        ]
+        return sorted(rows, key=lambda row: -row[1])[:limit]
+
+metrics = Metrics()
+
+def timed(name: str, **labels):
+    """Декоратор: время выполнения корутины в гистограмму name (по умолчанию метка op=имя функции)"""
+    def decorator(func):
+        key = tuple(labels.items()) or (("op", func.__name__),)
+        
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                metrics.observe(name, key, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
 # ============== DATABASE ==============
+class Database:
+    """Долгоживущие соединения SQLite: пул читателей + один писатель"""
+
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self.readers_count = readers
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._connections: list[aiosqlite.Connection] = []
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path, cached_statements=DB_CACHED_STATEMENTS)
+        # executescript, чтобы PRAGMA с результатом не держали открытый курсор (и блокировку)
+        await conn.executescript(f"""
+            PRAGMA busy_timeout = {DB_BUSY_TIMEOUT};
+            PRAGMA synchronous = NORMAL;
+            PRAGMA cache_size = -{DB_CACHE_SIZE_KB};
+            PRAGMA mmap_size = {DB_MMAP_SIZE};
+            PRAGMA temp_store = MEMORY;
+        """)
+        self._connections.append(conn)
+        return conn
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        self._writer = await self._connect()
+        # WAL хранится в файле БД — достаточно включить один раз на писателе
+        await self._writer.executescript("PRAGMA journal_mode = WAL;")
+        for _ in range(self.readers_count):
+            self._readers.put_nowait(await self._connect())
+
+    async def close(self):
+        async with self._write_lock:
+            for conn in self._connections:
+                await conn.close()
+            self._connections.clear()
+            self._readers = asyncio.Queue()
+            self._writer = None
+
+    @asynccontextmanager
+    async def reader(self):
+        """Соединение для чтения из пула"""
+        start = time.perf_counter()
+        conn = await self._readers.get()
+        metrics.observe("bot_db_wait_seconds", (("conn", "reader"),), time.perf_counter() - start)
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        """Единственное соединение для записи; commit на выходе, rollback при ошибке"""
+        start = time.perf_counter()
+        async with self._write_lock:
+            metrics.observe("bot_db_wait_seconds", (("conn", "writer"),), time.perf_counter() - start)
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
+
+db_pool = Database(DB_PATH)
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
+    """Открыть соединения и загрузить юзеров; схему в --workers уже подготовил супервизор"""
+    await db_pool.open()
+    if PROCESS_ROLE == "single":
+        await migrate_db()
+    await user_registry.load()
+
+async def prepare_db():
+    """Супервизор: схема и миграции один раз до запуска процессов — иначе они гоняются друг с другом"""
+    await db_pool.open()
+    try:
+        await migrate_db()
+    finally:
+        await close_db()
+
+async def migrate_db():
+    """Создать таблицы, триггеры и выполнить миграции"""
+    async with db_pool.writer() as db:
         await db.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 username TEXT,
                 first_name TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_banned INTEGER DEFAULT 0
+                is_banned INTEGER DEFAULT 0,
+                is_blocked INTEGER DEFAULT 0
             )
         """)
+        # Миграция: is_blocked — юзер заблокировал бота (ставится по ошибке отправки)
+        columns = {row[1] for row in await _fetch_all(db, "PRAGMA table_info(users)")}
+        if "is_blocked" not in columns:
+            await db.execute("ALTER TABLE users ADD COLUMN is_blocked INTEGER DEFAULT 0")
         await db.execute("""
             CREATE TABLE IF NOT EXISTS requests (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -67,90 +448,1169 @@ async def init_db():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        await db.commit()
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_banned ON users (is_banned)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_requests_created ON requests (created_at)")
+        await init_stats(db)
+        await init_history(db)
+        await init_alerts(db)
+        await init_broadcasts(db)
+        await init_rollups(db)
+    await migrate_auto_vacuum()
 
+async def init_stats(db: aiosqlite.Connection):
+    """Счётчики статистики, которые поддерживаются триггерами (без COUNT(*) по таблицам)"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users_daily (
+            day TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS requests_daily (
+            day TEXT,
+            request_type TEXT,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, request_type)
+        ) WITHOUT ROWID
+    """)
+    
+    # Первый запуск на существующей БД — один раз считаем всё по таблицам
+    if await _fetch_value(db, "SELECT COUNT(*) FROM stats_counters") == 0:
+        logging.info("Building statistics counters from existing tables")
+        await db.execute("""
+            INSERT INTO stats_counters (name, value)
+            SELECT 'users', COUNT(*) FROM users
+            UNION ALL SELECT 'banned', COUNT(*) FROM users WHERE is_banned = 1
+            UNION ALL SELECT 'requests', COUNT(*) FROM requests
+        """)
+        await db.execute("DELETE FROM users_daily")
+        await db.execute("""
+            INSERT INTO users_daily (day, count)
+            SELECT date(created_at), COUNT(*) FROM users GROUP BY date(created_at)
+        """)
+        await db.execute("DELETE FROM requests_daily")
+        await db.execute("""
+            INSERT INTO requests_daily (day, request_type, count)
+            SELECT date(created_at), COALESCE(request_type, ''), COUNT(*) FROM requests
+            GROUP BY date(created_at), COALESCE(request_type, '')
+        """)
+    
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_insert AFTER INSERT ON users BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'users';
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'banned' AND NEW.is_banned = 1;
+            INSERT INTO users_daily (day, count) VALUES (date(NEW.created_at), 1)
+                ON CONFLICT (day) DO UPDATE SET count = count + 1;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_delete AFTER DELETE ON users BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'users';
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'banned' AND OLD.is_banned = 1;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_ban AFTER UPDATE OF is_banned ON users
+        WHEN COALESCE(NEW.is_banned, 0) != COALESCE(OLD.is_banned, 0) BEGIN
+            UPDATE stats_counters
+            SET value = value + (CASE WHEN NEW.is_banned = 1 THEN 1 ELSE -1 END)
+            WHERE name = 'banned';
+        END
+    """)
+    # Удаление старых строк requests не уменьшает счётчик — он считает за всё время
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_requests_insert AFTER INSERT ON requests BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'requests';
+            INSERT INTO requests_daily (day, request_type, count)
+                VALUES (date(NEW.created_at), COALESCE(NEW.request_type, ''), 1)
+                ON CONFLICT (day, request_type) DO UPDATE SET count = count + 1;
+        END
+    """)
+
+async def close_db():
+    await db_pool.close()
+
+class UserRegistry:
+    """Известные юзеры, баны и заблокировавшие бота в памяти: проверки без обращения к БД"""
+
+    def __init__(self):
+        self.known: set[int] = set()
+        self.banned: set[int] = set()
+        self.blocked: set[int] = set()
+
+    @timed("bot_db_seconds", op="load_registry")
+    async def load(self):
+        known, banned, blocked = set(), set(), set()
+        async with db_pool.reader() as db:
+            async with db.execute("SELECT user_id, is_banned, is_blocked FROM users") as cursor:
+                async for user_id, is_banned, is_blocked in cursor:
+                    known.add(user_id)
+                    if is_banned:
+                        banned.add(user_id)
+                    if is_blocked:
+                        blocked.add(user_id)
+        self.known, self.banned, self.blocked = known, banned, blocked
+        logging.info("User registry loaded: %d users, %d banned, %d blocked",
+                     len(known), len(banned), len(blocked))
+
+    @timed("bot_db_seconds", op="reload_bans")
+    async def reload_bans(self):
+        """Перечитать баны — их могли поменять другие процессы"""
+        async with db_pool.reader() as db:
+            rows = await _fetch_all(db, "SELECT user_id FROM users WHERE is_banned = 1")
+        self.banned = {user_id for user_id, in rows}
+
+user_registry = UserRegistry()
+
+@timed("bot_db_seconds")
 async def add_user(user_id: int, username: str, first_name: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    # В БД пишем только тех, кого ещё не видели
+    if user_id in user_registry.known:
+        return
+    async with db_pool.writer() as db:
         await db.execute(
             "INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
             (user_id, username, first_name)
         )
-        await db.commit()
+    user_registry.known.add(user_id)
 
 async def is_banned(user_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
-            "SELECT is_banned FROM users WHERE user_id = ?", (user_id,)
-        )
-        row = await cursor.fetchone()
-        return row[0] == 1 if row else False
+    return user_id in user_registry.banned
 
+@timed("bot_db_seconds")
 async def ban_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET is_banned = 1 WHERE user_id = ?", (user_id,))
-        await db.commit()
+    async with db_pool.writer() as db:
+        cursor = await db.execute("UPDATE users SET is_banned = 1 WHERE user_id = ?", (user_id,))
+        updated = cursor.rowcount
+    if updated:
+        user_registry.banned.add(user_id)
 
+@timed("bot_db_seconds")
 async def unban_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.writer() as db:
         await db.execute("UPDATE users SET is_banned = 0 WHERE user_id = ?", (user_id,))
-        await db.commit()
+    user_registry.banned.discard(user_id)
 
-async def get_all_users():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT user_id, username, first_name, is_banned, created_at FROM users")
+@timed("bot_db_seconds")
+async def set_blocked(user_id: int, blocked: bool):
+    """Юзер заблокировал бота (ошибка отправки) или вернулся (/start)"""
+    # Флаг ставит процесс, который отправляет (с --workers — загрузчик), а снимает тот,
+    # кому пришёл /start: память процесса тут не источник правды, только в одиночном режиме
+    if PROCESS_ROLE == "single" and (user_id in user_registry.blocked) == blocked:
+        return
+    async with db_pool.writer() as db:
+        await db.execute(
+            "UPDATE users SET is_blocked = ? WHERE user_id = ? AND is_blocked != ?",
+            (int(blocked), user_id, int(blocked))
+        )
+    if blocked:
+        user_registry.blocked.add(user_id)
+    else:
+        user_registry.blocked.discard(user_id)
+
+async def _fetch_value(db: aiosqlite.Connection, sql: str, params: tuple = ()):
+    async with db.execute(sql, params) as cursor:
+        return (await cursor.fetchone())[0]
+
+async def _fetch_all(db: aiosqlite.Connection, sql: str, params: tuple = ()):
+    async with db.execute(sql, params) as cursor:
         return await cursor.fetchall()
 
+@timed("bot_db_seconds")
 async def get_stats():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT COUNT(*) FROM users")
-        total = (await cursor.fetchone())[0]
-        
-        cursor = await db.execute("SELECT COUNT(*) FROM users WHERE is_banned = 1")
-        banned = (await cursor.fetchone())[0]
-        
-        cursor = await db.execute("SELECT COUNT(*) FROM requests")
-        requests = (await cursor.fetchone())[0]
-        
-        cursor = await db.execute(
-            "SELECT COUNT(*) FROM users WHERE created_at >= date('now', '-1 day')"
+    async with db_pool.reader() as db:
+        counters = dict(await _fetch_all(db, "SELECT name, value FROM stats_counters"))
+        today = await _fetch_value(
+            db, "SELECT COALESCE(SUM(count), 0) FROM users_daily WHERE day >= date('now', '-1 day')"
+        )
+        by_type = await _fetch_all(
+            db,
+            "SELECT request_type, count FROM requests_daily WHERE day = date('now') ORDER BY count DESC"
+        )
+        by_day = await _fetch_all(
+            db,
+            "SELECT day, SUM(count) FROM requests_daily WHERE day >= date('now', '-6 day') "
+            "GROUP BY day ORDER BY day DESC"
         )
-        today = (await cursor.fetchone())[0]
         
-        return {"total": total, "banned": banned, "requests": requests, "today": today}
+        return {
+            "total": counters.get("users", 0),
+            "banned": counters.get("banned", 0),
+            "requests": counters.get("requests", 0),
+            "today": today,
+            "requests_by_type": by_type,   # [(request_type, count)] за сегодня
+            "requests_by_day": by_day      # [(day, count)] за 7 дней
+        }
+
+# Фильтры списка юзеров: условие WHERE, ключ сортировки (keyset) и подпись кнопки
+USER_FILTERS = {
+    "all": ("", ("user_id",), "Все"),
+    "banned": ("is_banned = 1", ("user_id",), "🚫 Забаненные"),
+    "today": ("created_at >= date('now', '-1 day')", ("created_at", "user_id"), "🆕 Новые")
+}
+
+_users_count_cache: dict[str, tuple[int, float]] = {}
+
+@timed("bot_db_seconds")
+async def get_users_page(flt: str, cursor: Optional[int] = None, forward: bool = True,
+                         limit: int = ADMIN_USERS_PAGE_SIZE):
+    """Страница юзеров после/до cursor (user_id): один индексный запрос на limit + 1 строк"""
+    condition, key, _ = USER_FILTERS[flt]
+    conditions = [condition] if condition else []
+    params: list = []
+    
+    if cursor is not None:
+        op = ">" if forward else "<"
+        if key == ("user_id",):
+            conditions.append(f"user_id {op} ?")
+            params.append(cursor)
+        else:
+            # Составной ключ: created_at берём у юзера-курсора
+            conditions.append(
+                f"(created_at, user_id) {op} ((SELECT created_at FROM users WHERE user_id = ?), ?)"
+            )
+            params += [cursor, cursor]
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    order = ", ".join(f"{column} {'ASC' if forward else 'DESC'}" for column in key)
+    params.append(limit + 1)
+    
+    async with db_pool.reader() as db:
+        rows = await _fetch_all(
+            db,
+            f"SELECT user_id, username, first_name, is_banned, created_at FROM users "
+            f"{where} ORDER BY {order} LIMIT ?",
+            tuple(params)
+        )
+    
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if forward:
+        return rows, cursor is not None, more
+    rows.reverse()
+    return rows, more, True
+
+@timed("bot_db_seconds")
+async def count_users(flt: str) -> int:
+    """Количество юзеров по фильтру — из счётчиков статистики, с коротким кэшем"""
+    cached = _users_count_cache.get(flt)
+    if cached and time.monotonic() - cached[1] < ADMIN_USERS_COUNT_TTL:
+        return cached[0]
+    
+    stats = await get_stats()
+    count = {"all": stats["total"], "banned": stats["banned"], "today": stats["today"]}[flt]
+    _users_count_cache[flt] = (count, time.monotonic())
+    return count
+
+class RequestLogWriter:
+    """Очередь лога запросов; фоновый flusher пишет пачки одной транзакцией"""
+
+    def __init__(self, maxsize: int = LOG_QUEUE_SIZE, batch_size: int = LOG_BATCH_SIZE,
+                 interval: float = LOG_FLUSH_INTERVAL, policy: str = LOG_QUEUE_POLICY):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.policy = policy
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._batch_ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Дописать всё, что осталось в очереди, и остановить flusher"""
+        if self._task is None:
+            return
+        await self.queue.put(None)
+        self._batch_ready.set()
+        await self._task
+        self._task = None
+
+    async def put(self, record: tuple):
+        if self.policy == "block":
+            await self.queue.put(record)
+        else:
+            try:
+                self.queue.put_nowait(record)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                return
+        if self.queue.qsize() >= self.batch_size:
+            self._batch_ready.set()
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            # Ждём либо полную пачку, либо истечения интервала
+            if batch[0] is not None and self.queue.qsize() + 1 < self.batch_size:
+                self._batch_ready.clear()
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            
+            stopping = None in batch
+            records = [r for r in batch if r is not None]
+            if records:
+                await self._write(records)
+            if stopping and self.queue.empty():
+                return
+
+    @timed("bot_db_seconds", op="write_request_log")
+    async def _write(self, records: list[tuple]):
+        try:
+            async with db_pool.writer() as db:
+                await db.executemany(
+                    "INSERT INTO requests (user_id, request_type, query, created_at) VALUES (?, ?, ?, ?)",
+                    records
+                )
+            self.written += len(records)
+        except Exception:
+            self.failed += len(records)
+            logging.exception("Failed to write %d request log records", len(records))
+
+request_log = RequestLogWriter()
 
 async def log_request(user_id: int, request_type: str, query: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    # created_at фиксируем в момент запроса, формат как у CURRENT_TIMESTAMP
+    created_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    await request_log.put((user_id, request_type, query, created_at))
+
+# ============== ОБСЛУЖИВАНИЕ ЛОГА ЗАПРОСОВ ==============
+# Запросы, из которых берём топ символов (в инлайне — недописанные префиксы)
+SYMBOL_REQUEST_TYPES = ("command", "text", "button", "history", "alert")
+
+async def init_rollups(db: aiosqlite.Connection):
+    """Агрегаты лога по дням; watermark — последний учтённый requests.id"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS request_rollups (
+            day TEXT,
+            request_type TEXT,
+            query TEXT,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, request_type, query)
+        ) WITHOUT ROWID
+    """)
+    await db.execute("INSERT OR IGNORE INTO stats_counters (name, value) VALUES ('rollup_watermark', 0)")
+
+async def migrate_auto_vacuum():
+    """Разово перевести БД на auto_vacuum = INCREMENTAL — включается только через полный VACUUM"""
+    async with db_pool.writer() as db:
+        if await _fetch_value(db, "PRAGMA auto_vacuum") == 2:
+            return
+        logging.info("Switching database to incremental auto_vacuum (one-time VACUUM)")
+        await db.executescript("PRAGMA auto_vacuum = INCREMENTAL; VACUUM;")
+
+@timed("bot_db_seconds", op="rollup_requests")
+async def rollup_requests() -> int:
+    """Досчитать агрегаты по строкам после watermark, пачками по id"""
+    rolled = 0
+    while True:
+        async with db_pool.writer() as db:
+            watermark = await _fetch_value(db, "SELECT value FROM stats_counters WHERE name = 'rollup_watermark'")
+            last_id = await _fetch_value(db, "SELECT COALESCE(MAX(id), 0) FROM requests")
+            upto = min(last_id, watermark + REQUEST_ROLLUP_BATCH)
+            if upto <= watermark:
+                break
+            await db.execute("""
+                INSERT INTO request_rollups (day, request_type, query, count)
+                SELECT date(created_at), COALESCE(request_type, ''), COALESCE(query, ''), COUNT(*)
+                FROM requests WHERE id > ? AND id <= ?
+                GROUP BY 1, 2, 3
+                ON CONFLICT (day, request_type, query) DO UPDATE SET count = count + excluded.count
+            """, (watermark, upto))
+            await db.execute("UPDATE stats_counters SET value = ? WHERE name = 'rollup_watermark'", (upto,))
+        rolled += upto - watermark
+        if upto == last_id:
+            break
+        await asyncio.sleep(0)
+    return rolled
+
+@timed("bot_db_seconds", op="prune_requests")
+async def prune_requests() -> int:
+    """Удалить уже агрегированные строки старше срока хранения — короткими транзакциями"""
+    deleted = 0
+    while True:
+        async with db_pool.writer() as db:
+            cursor = await db.execute("""
+                DELETE FROM requests WHERE id IN (
+                    SELECT id FROM requests
+                    WHERE created_at < datetime('now', ?)
+                      AND id <= (SELECT value FROM stats_counters WHERE name = 'rollup_watermark')
+                    ORDER BY id LIMIT ?
+                )
+            """, (f"-{REQUEST_LOG_RETENTION_DAYS} days", REQUEST_DELETE_BATCH))
+            count = cursor.rowcount
+        deleted += count
+        if count < REQUEST_DELETE_BATCH:
+            break
+        # Между пачками писатель достаётся хендлерам (asyncio.Lock честный)
+        await asyncio.sleep(0)
+    
+    async with db_pool.writer() as db:
         await db.execute(
-            "INSERT INTO requests (user_id, request_type, query) VALUES (?, ?, ?)",
-            (user_id, request_type, query)
+            "DELETE FROM request_rollups WHERE day < date('now', ?)", (f"-{REQUEST_ROLLUP_RETENTION_DAYS} days",)
         )
-        await db.commit()
+    return deleted
 
-# ============== API ФУНКЦИИ ==============
-async def get_crypto_prices(symbols: list[str]) -> dict:
-    """Получить цены криптовалют"""
-    ids = [CRYPTO_IDS.get(s.lower(), s.lower()) for s in symbols]
-    ids_str = ",".join(ids)
+@timed("bot_db_seconds", op="incremental_vacuum")
+async def incremental_vacuum():
+    async with db_pool.writer() as db:
+        if await _fetch_value(db, "PRAGMA freelist_count"):
+            await db.executescript(f"PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES});")
+
+async def request_log_maintainer():
+    """Фоновая задача: агрегаты, удаление старых строк лога и возврат места"""
+    while True:
+        await asyncio.sleep(REQUEST_MAINTENANCE_INTERVAL)
+        try:
+            rolled = await rollup_requests()
+            deleted = await prune_requests()
+            await incremental_vacuum()
+            if deleted:
+                logging.info("Request log maintenance: %d rolled up, %d pruned", rolled, deleted)
+        except Exception:
+            logging.exception("Request log maintenance failed")
+
+async def get_top_symbols(days: int, limit: int = TOP_SYMBOLS_LIMIT):
+    """Топ символов и запросы по типам за последние days дней — из агрегатов, без сырого лога"""
+    since = f"-{days} days"
+    placeholders = ",".join("?" * len(SYMBOL_REQUEST_TYPES))
+    async with db_pool.reader() as db:
+        symbols = await _fetch_all(db, f"""
+            SELECT UPPER(query), SUM(count) FROM request_rollups
+            WHERE day > date('now', ?) AND request_type IN ({placeholders}) AND query != ''
+            GROUP BY 1 ORDER BY 2 DESC LIMIT ?
+        """, (since, *SYMBOL_REQUEST_TYPES, limit))
+        by_type = await _fetch_all(db, """
+            SELECT request_type, SUM(count) FROM requests_daily
+            WHERE day > date('now', ?) GROUP BY 1 ORDER BY 2 DESC
+        """, (since,))
+    return symbols, by_type
+
+# ============== ЭКСПОРТ ==============
+class SpooledInputFile(InputFile):
+    """Отправка временного файла в Telegram кусками, без чтения целиком в память"""
+
+    def __init__(self, file, filename: str):
+        super().__init__(filename=filename)
+        self.file = file
+
+    async def read(self, bot: Bot):
+        self.file.seek(0)
+        while chunk := self.file.read(self.chunk_size):
+            yield chunk
+
+async def export_query(sql: str, header: list[str], fmt: str = "tsv", compress: bool = False):
+    """Выгрузить результат запроса в SpooledTemporaryFile по EXPORT_CHUNK_ROWS строк"""
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX)
+    raw = gzip.GzipFile(fileobj=spool, mode="wb") if compress else spool
+    out = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    writer = csv.writer(out, delimiter="\t" if fmt == "tsv" else ",", lineterminator="\n")
+    writer.writerow(header)
+    
+    count = 0
+    try:
+        async with db_pool.reader() as db:
+            async with db.execute(sql) as cursor:
+                while rows := await cursor.fetchmany(EXPORT_CHUNK_ROWS):
+                    writer.writerows(rows)
+                    count += len(rows)
+        out.flush()
+        out.detach()  # не закрываем spool вместе с обёрткой
+        if compress:
+            raw.close()
+    except BaseException:
+        spool.close()
+        raise
     
-    async with aiohttp.ClientSession() as session:
-        url = f"{CRYPTO_API}/simple/price?ids={ids_str}&vs_currencies=usd,rub,eur&include_24hr_change=true"
-        async with session.get(url) as resp:
+    spool.seek(0)
+    return spool, count
+
+async def export_users():
+    return await export_query(
+        "SELECT user_id, COALESCE(username, '-'), COALESCE(first_name, '-'), is_banned, created_at "
+        "FROM users ORDER BY user_id",
+        ["user_id", "username", "first_name", "is_banned", "created_at"]
+    )
+
+async def export_requests():
+    return await export_query(
+        "SELECT id, user_id, request_type, query, created_at FROM requests ORDER BY id",
+        ["id", "user_id", "request_type", "query", "created_at"],
+        fmt="csv", compress=True
+    )
+
+# ============== HTTP КЛИЕНТ ==============
+http_session: Optional[aiohttp.ClientSession] = None
+
+async def init_http():
+    """Создать общую HTTP-сессию (keep-alive, лимиты, DNS кэш)"""
+    global http_session
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_LIMIT,
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        ttl_dns_cache=HTTP_DNS_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE
+    )
+    timeout = aiohttp.ClientTimeout(total=HTTP_TOTAL_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+async def close_http():
+    """Закрыть общую HTTP-сессию"""
+    global http_session
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+
+async def fetch_json(url: str):
+    """GET через общую сессию, None если ответ не 200"""
+    if http_session is None:
+        raise RuntimeError("HTTP client is not initialised, call init_http() first")
+    host = (("host", urlsplit(url).hostname),)
+    status = "error"
+    start = time.perf_counter()
+    try:
+        async with http_session.get(url) as resp:
+            status = str(resp.status)
             if resp.status == 200:
                 return await resp.json()
-    return {}
+        return None
+    finally:
+        metrics.observe("bot_upstream_seconds", host, time.perf_counter() - start)
+        metrics.inc("bot_upstream_requests_total", host + (("status", status),))
+
+# ============== КЭШ ==============
+class TTLCache:
+    """TTL кэш со stale-while-revalidate и single-flight на ключ"""
+
+    def __init__(self, max_keys: int = PRICE_CACHE_MAX_KEYS):
+        self.max_keys = max_keys
+        self._data = {}       # key -> (value, fetched_at)
+        self._inflight = {}   # key -> asyncio.Task
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, key: str, loader, ttl: float, stale_ttl: float):
+        entry = self._data.get(key)
+        if entry is not None:
+            value, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            if age < ttl:
+                self.hits += 1
+                return value
+            if age < ttl + stale_ttl:
+                # Отдаём старое сразу, обновление — в фоне
+                self.stale_hits += 1
+                self._load(key, loader)
+                return value
+        
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = self._load(key, loader)
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(task)
+
+    def _load(self, key: str, loader) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._run(key, loader))
+            task.add_done_callback(self._log_error)
+            self._inflight[key] = task
+        return task
+
+    async def _run(self, key: str, loader):
+        try:
+            value = await loader()
+            # Пустой ответ (ошибка API) не кэшируем
+            if value:
+                self._data.pop(key, None)
+                self._data[key] = (value, time.monotonic())
+                if len(self._data) > self.max_keys:
+                    self._data.pop(next(iter(self._data)))
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    @staticmethod
+    def _log_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning("Price cache refresh failed: %r", task.exception())
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "keys": len(self._data),
+            "inflight": len(self._inflight)
+        }
+
+price_cache = TTLCache()
+
+# ============== ИСТОЧНИКИ ЦЕН ==============
+# Каждый источник возвращает данные в формате CoinGecko / ExchangeRate-API
+# ({coin_id: {"usd", "rub", "eur", "usd_24h_change"}} и {код: курс к USD}) или None при ошибке
+async def coingecko_prices(ids: list[str]) -> Optional[dict]:
+    ids_str = ",".join(ids)
+    url = f"{CRYPTO_API}/simple/price?ids={ids_str}&vs_currencies=usd,rub,eur&include_24hr_change=true"
+    return await fetch_json(url)
+
+def _fsyms_chunks(symbols: list[str]) -> list[str]:
+    """Тикеры через запятую кусками до CRYPTOCOMPARE_FSYMS_MAX символов (лимит API)"""
+    chunks, current = [], ""
+    for symbol in symbols:
+        if current and len(current) + 1 + len(symbol) > CRYPTOCOMPARE_FSYMS_MAX:
+            chunks.append(current)
+            current = ""
+        current = f"{current},{symbol}" if current else symbol
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def cryptocompare_prices(ids: list[str]) -> Optional[dict]:
+    # CryptoCompare знает тикеры, а не id CoinGecko. Тикер — цена самой крупной монеты
+    # с ним, поэтому остальные монеты с тем же тикером здесь не оцениваем
+    symbols = {}
+    for coin_id in ids:
+        symbol = coin_catalog.symbol_of.get(coin_id)
+        if symbol and coin_catalog.resolve(symbol) == coin_id:
+            symbols[coin_id] = symbol.upper()
+    chunks = _fsyms_chunks(sorted(set(symbols.values())))
+    if not chunks:
+        return {}
+    responses = await asyncio.gather(*(
+        fetch_json(f"{CRYPTOCOMPARE_API}/pricemultifull?fsyms={fsyms}&tsyms=USD,RUB,EUR")
+        for fsyms in chunks
+    ))
+    raw_all = {}
+    for data in responses:
+        if data is None or "RAW" not in data:
+            return None
+        raw_all.update(data["RAW"])
+    prices = {}
+    for coin_id, symbol in symbols.items():
+        raw = raw_all.get(symbol)
+        if not raw or "USD" not in raw:
+            continue
+        prices[coin_id] = {
+            "usd": raw["USD"].get("PRICE"),
+            "rub": raw.get("RUB", {}).get("PRICE"),
+            "eur": raw.get("EUR", {}).get("PRICE"),
+            "usd_24h_change": raw["USD"].get("CHANGEPCT24HOUR"),
+        }
+    return prices
+
+async def exchangerate_api_rates() -> Optional[dict]:
+    data = await fetch_json(FIAT_API)
+    return data.get("rates") if data else None
+
+async def open_er_api_rates() -> Optional[dict]:
+    data = await fetch_json(OPEN_ER_API)
+    if not data or data.get("result") != "success":
+        return None
+    return data.get("rates")
+
+class ProviderError(Exception):
+    pass
+
+class Provider:
+    """Источник данных со своим бюджетом задержки, circuit breaker и окном задержек"""
+
+    def __init__(self, name: str, fetch, timeout: Optional[float] = None):
+        self.name = name
+        self.fetch = fetch
+        self.timeout = timeout or PROVIDER_TIMEOUTS.get(name, PROVIDER_TIMEOUT)
+        self.latencies: deque = deque(maxlen=HEDGE_WINDOW)
+        self.failures = 0
+        self.open_until = 0.0
+
+    def available(self) -> bool:
+        # После BREAKER_COOLDOWN пропускаем пробный запрос; упадёт — снова выключится
+        return time.monotonic() >= self.open_until
+
+    def hedge_delay(self) -> float:
+        """Сколько ждать ответа, прежде чем параллельно спросить следующий источник: p95 задержки"""
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        ordered = sorted(self.latencies)
+        return max(HEDGE_MIN_DELAY, ordered[int(len(ordered) * 0.95)])
+
+    def _failed(self, result: str):
+        metrics.inc("bot_provider_requests_total", (("provider", self.name), ("result", result)))
+        self.failures += 1
+        if self.failures >= BREAKER_FAILURES:
+            if self.available():
+                logging.warning("Provider %s disabled for %ss after %d failures",
+                                self.name, BREAKER_COOLDOWN, self.failures)
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN
+
+    async def call(self, *args) -> dict:
+        start = time.monotonic()
+        try:
+            result = await asyncio.wait_for(self.fetch(*args), self.timeout)
+        except asyncio.TimeoutError:
+            self._failed("timeout")
+            raise ProviderError(f"{self.name}: no answer in {self.timeout}s")
+        except Exception as e:
+            self._failed("error")
+            raise ProviderError(f"{self.name}: {e!r}") from e
+        if result is None:
+            self._failed("error")
+            raise ProviderError(f"{self.name}: bad response")
+        
+        self.latencies.append(time.monotonic() - start)
+        self.failures = 0
+        self.open_until = 0.0
+        metrics.inc("bot_provider_requests_total", (("provider", self.name), ("result", "ok")))
+        return result
+
+async def hedged_fetch(providers: list[Provider], *args) -> dict:
+    """Спросить основной источник; не ответил за свой p95 или упал — следующий, берём первый ответ"""
+    queue = [p for p in providers if p.available()]
+    if not queue:
+        logging.warning("All providers are disabled: %s", ", ".join(p.name for p in providers))
+        return {}
+    
+    pending: set[asyncio.Task] = set()
+    best: dict = {}
+    try:
+        while queue or pending:
+            delay = None
+            if queue:
+                provider = queue.pop(0)
+                if pending:
+                    metrics.inc("bot_provider_hedges_total", (("provider", provider.name),))
+                pending.add(asyncio.create_task(provider.call(*args)))
+                if queue:
+                    delay = provider.hedge_delay()
+            done, pending = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    logging.warning("Price provider failed: %s", task.exception())
+                    continue
+                result = task.result()
+                # Пустой или неполный ответ не обгоняет источник, который ещё отвечает
+                if not _is_complete(result, args) and (pending or (queue and not result)):
+                    if len(result) > len(best):
+                        best = result
+                    continue
+                return result if len(result) >= len(best) else best
+    except asyncio.CancelledError:
+        for task in pending:
+            task.cancel()
+        raise
+    finally:
+        # Проигравшие дорабатывают в фоне (не дольше своего бюджета): иначе в окно p95
+        # не попадали бы медленные ответы и источник выглядел бы быстрее, чем есть
+        for task in pending:
+            task.add_done_callback(_discard_result)
+    return best
+
+def _is_complete(result: dict, args: tuple) -> bool:
+    """Ответ не пустой и (для крипты) содержит все запрошенные id"""
+    if not result:
+        return False
+    return not args or all(coin_id in result for coin_id in args[0])
+
+def _discard_result(task: asyncio.Task):
+    if not task.cancelled():
+        task.exception()
+
+PROVIDERS = {
+    "coingecko": Provider("coingecko", coingecko_prices),
+    "cryptocompare": Provider("cryptocompare", cryptocompare_prices),
+    "exchangerate-api": Provider("exchangerate-api", exchangerate_api_rates),
+    "open-er-api": Provider("open-er-api", open_er_api_rates),
+}
+
+# ============== API ФУНКЦИИ ==============
+async def fetch_crypto_prices(ids: list[str]) -> dict:
+    """Запросить цены криптовалют (без кэша): основной источник, при проблемах — запасные"""
+    return await hedged_fetch([PROVIDERS[name] for name in CRYPTO_PROVIDERS], ids)
+
+async def fetch_fiat_rates() -> dict:
+    """Запросить курсы фиатных валют (без кэша): основной источник, при проблемах — запасные"""
+    return await hedged_fetch([PROVIDERS[name] for name in FIAT_PROVIDERS])
+
+async def get_crypto_prices(symbols: list[str]) -> dict:
+    """Получить цены криптовалют"""
+    ids = sorted({CRYPTO_IDS.get(s.lower(), s.lower()) for s in symbols})
+    return await price_cache.get(
+        "crypto:" + ",".join(ids),
+        lambda: fetch_crypto_prices(ids),
+        CRYPTO_CACHE_TTL, CRYPTO_CACHE_STALE
+    )
 
 async def get_fiat_rates() -> dict:
     """Получить курсы фиатных валют"""
-    async with aiohttp.ClientSession() as session:
-        async with session.get(FIAT_API) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                return data.get("rates", {})
-    return {}
+    return await price_cache.get("fiat", fetch_fiat_rates, FIAT_CACHE_TTL, FIAT_CACHE_STALE)
+
+# ============== СНАПШОТ ЦЕН ==============
+class PriceSnapshot(NamedTuple):
+    version: int
+    crypto: Mapping      # coin_id -> {"usd", "rub", "eur", "usd_24h_change"}
+    fiat: Mapping        # код валюты -> курс к USD
+    updated_at: float    # time.time() последнего обновления крипты
+    fiat_updated_at: float = 0.0  # time.time() последнего обновления фиата
+    restored: bool = False       # крипта поднята с диска: годна до первого обновления крипты
+    fiat_restored: bool = False  # то же для фиата
+
+def _freeze(data: dict) -> Mapping:
+    return MappingProxyType({
+        k: MappingProxyType(dict(v)) if isinstance(v, dict) else v
+        for k, v in data.items()
+    })
+
+price_snapshot = PriceSnapshot(0, MappingProxyType({}), MappingProxyType({}), 0.0)
+
+def publish_snapshot(crypto: Mapping, fiat: Mapping, updated_at: Optional[float] = None,
+                     fiat_updated_at: Optional[float] = None, restored: bool = False,
+                     fiat_restored: bool = False) -> PriceSnapshot:
+    """Заменить текущий снапшот новым (старый не меняется)"""
+    global price_snapshot
+    updated_at = time.time() if updated_at is None else updated_at
+    price_snapshot = PriceSnapshot(
+        price_snapshot.version + 1,
+        crypto if isinstance(crypto, MappingProxyType) else _freeze(crypto),
+        fiat if isinstance(fiat, MappingProxyType) else _freeze(fiat),
+        updated_at,
+        updated_at if fiat_updated_at is None else fiat_updated_at,
+        restored,
+        fiat_restored
+    )
+    if shared_snapshot is not None and shared_snapshot.writable:
+        shared_snapshot.write(price_snapshot)
+    return price_snapshot
+
+def snapshot_is_fresh(snap: PriceSnapshot) -> bool:
+    """Крипта в снапшоте достаточно свежая, чтобы отвечать из него"""
+    if snap.version == 0:
+        return False
+    age = time.time() - snap.updated_at
+    return age < PRICE_SNAPSHOT_MAX_AGE or (snap.restored and age < PRICE_SNAPSHOT_RESTORE_MAX_AGE)
+
+def fiat_is_fresh(snap: PriceSnapshot) -> bool:
+    """То же для курсов фиата: у них своё время обновления"""
+    if snap.version == 0 or not snap.fiat:
+        return False
+    age = time.time() - snap.fiat_updated_at
+    return age < FIAT_SNAPSHOT_MAX_AGE or (snap.fiat_restored and age < PRICE_SNAPSHOT_RESTORE_MAX_AGE)
+
+def _read_snapshot_file(path: str) -> Optional[dict]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _write_snapshot_file(path: str, snap: PriceSnapshot):
+    data = {
+        "updated_at": snap.updated_at,
+        "fiat_updated_at": snap.fiat_updated_at,
+        "crypto": {coin_id: dict(info) for coin_id, info in snap.crypto.items()},
+        "fiat": dict(snap.fiat),
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+async def load_saved_snapshot():
+    """Поднять снапшот с диска, чтобы первые юзеры после рестарта не ждали внешние API"""
+    try:
+        data = await asyncio.to_thread(_read_snapshot_file, PRICE_SNAPSHOT_PATH)
+    except Exception:
+        logging.exception("Failed to load price snapshot from %s", PRICE_SNAPSHOT_PATH)
+        return
+    if not data:
+        return
+    # Половины проверяем по отдельности: крипта и фиат обновляются в разное время
+    now = time.time()
+    fiat_updated_at = data.get("fiat_updated_at", data["updated_at"])
+    crypto = data["crypto"] if now - data["updated_at"] < PRICE_SNAPSHOT_RESTORE_MAX_AGE else {}
+    fiat = data["fiat"] if now - fiat_updated_at < PRICE_SNAPSHOT_RESTORE_MAX_AGE else {}
+    if not crypto and not fiat:
+        return
+    snap = publish_snapshot(crypto, fiat, data["updated_at"], fiat_updated_at, restored=True, fiat_restored=True)
+    logging.info("Price snapshot restored: %d coins (%.0fs old), %d currencies (%.0fs old)",
+                 len(snap.crypto), now - snap.updated_at, len(snap.fiat), now - snap.fiat_updated_at)
+
+async def save_snapshot():
+    snap = price_snapshot
+    # Нечего сохранять, пока обе половины — ровно то, что подняли с диска
+    if snap.version == 0 or (snap.restored and snap.fiat_restored):
+        return
+    try:
+        await asyncio.to_thread(_write_snapshot_file, PRICE_SNAPSHOT_PATH, snap)
+    except Exception:
+        logging.exception("Failed to save price snapshot to %s", PRICE_SNAPSHOT_PATH)
+
+async def snapshot_saver():
+    """Фоновая задача: периодически сохраняет снапшот — на случай падения без on_shutdown"""
+    while True:
+        await asyncio.sleep(PRICE_SNAPSHOT_SAVE_INTERVAL)
+        await save_snapshot()
+
+# Вызываются после каждого обновления цен (только в процессе, который их загружает)
+snapshot_listeners: list = []
+
+def quote_updated_at(snap: PriceSnapshot, symbol: str) -> float:
+    """Когда обновлялась цена символа: у крипты и фиата своё время"""
+    return snap.updated_at if symbol.lower() in CRYPTO_IDS else snap.fiat_updated_at
+
+def snapshot_quote(snap: PriceSnapshot, symbol: str) -> Optional[float]:
+    """Цена символа из снапшота: крипта и фиат — в USD, сам USD — в RUB"""
+    symbol = symbol.upper()
+    coin_id = CRYPTO_IDS.get(symbol.lower())
+    if coin_id:
+        info = snap.crypto.get(coin_id)
+        return info.get("usd") if info else None
+    rate = snap.fiat.get(symbol)
+    if not rate:
+        return None
+    if symbol == "USD":
+        return snap.fiat.get("RUB")
+    return 1 / rate
+
+def quote_sign(symbol: str) -> str:
+    return "₽" if symbol.upper() == "USD" else "$"
+
+def format_quote(value: float, symbol: str) -> str:
+    """Цена с точностью по величине: 70,000.00 / 0.012345"""
+    digits = 2 if abs(value) >= 1 else 6
+    return f"{quote_sign(symbol)}{value:,.{digits}f}"
+
+def get_snapshot() -> PriceSnapshot:
+    """Текущий снапшот; в воркере — последний опубликованный в общем mmap-файле"""
+    global price_snapshot
+    if shared_snapshot is not None and not shared_snapshot.writable:
+        price_snapshot = shared_snapshot.read(price_snapshot)
+    return price_snapshot
+
+async def current_crypto_prices(symbols: list[str]) -> Mapping:
+    """Цены из снапшота; в сеть (через кэш) только если монеты там нет"""
+    snap = get_snapshot()
+    if snapshot_is_fresh(snap):
+        ids = [CRYPTO_IDS.get(s.lower(), s.lower()) for s in symbols]
+        if all(coin_id in snap.crypto for coin_id in ids):
+            return snap.crypto
+    return await get_crypto_prices(symbols)
+
+async def inline_crypto_prices(ids: list[str]) -> Mapping:
+    """Цены для инлайна: что есть в снапшоте — сразу, остальное одним запросом в пределах
+    INLINE_FETCH_BUDGET (не успел — запрос догрузит кэш в фоне, монета пойдёт без цены)"""
+    snap = get_snapshot()
+    crypto = snap.crypto if snapshot_is_fresh(snap) else {}
+    prices = {coin_id: crypto[coin_id] for coin_id in ids if coin_id in crypto}
+    missing = [coin_id for coin_id in ids if coin_id not in prices]
+    if missing:
+        try:
+            # Отмена ожидания не отменяет сам запрос: price_cache держит его под shield
+            fetched = await asyncio.wait_for(get_crypto_prices(missing), INLINE_FETCH_BUDGET)
+        except asyncio.TimeoutError:
+            fetched = {}
+        prices.update((coin_id, fetched[coin_id]) for coin_id in missing if coin_id in fetched)
+    return prices
 
-def format_crypto_price(data: dict, symbol: str) -> str:
+async def current_fiat_rates() -> Mapping:
+    """Курсы фиата из снапшота; в сеть (через кэш) только если снапшот пуст"""
+    snap = get_snapshot()
+    if fiat_is_fresh(snap):
+        return snap.fiat
+    return await get_fiat_rates()
+
+async def refresh_prices(with_fiat: bool) -> tuple[bool, bool]:
+    """Одним запросом обновить CRYPTO_IDS и топ каталога (и фиат) и опубликовать снапшот"""
+    ids = set(CRYPTO_IDS.values()) | set(coin_catalog.top(INLINE_SNAPSHOT_TOP))
+    jobs = [fetch_crypto_prices(sorted(ids))]
+    if with_fiat:
+        jobs.append(fetch_fiat_rates())
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    
+    for result in results:
+        if isinstance(result, Exception):
+            logging.warning("Price refresh request failed: %r", result)
+    crypto = results[0] if isinstance(results[0], dict) else {}
+    fiat = results[1] if with_fiat and isinstance(results[1], dict) else {}
+    
+    if crypto or fiat:
+        # Не обновившаяся половина сохраняет своё время — старые цены не выдаём за свежие
+        now = time.time()
+        snap = publish_snapshot(
+            crypto or price_snapshot.crypto, fiat or price_snapshot.fiat,
+            now if crypto else price_snapshot.updated_at,
+            now if fiat else price_snapshot.fiat_updated_at,
+            restored=not crypto and price_snapshot.restored,
+            fiat_restored=not fiat and price_snapshot.fiat_restored
+        )
+        for listener in snapshot_listeners:
+            try:
+                listener(snap)
+            except Exception:
+                logging.exception("Snapshot listener %s failed", listener.__name__)
+    return bool(crypto), bool(fiat)
+
+async def price_refresher():
+    """Фоновая задача: обновляет снапшот с джиттером и backoff при ошибках"""
+    failures = 0
+    last_fiat = None
+    while True:
+        with_fiat = last_fiat is None or time.monotonic() - last_fiat >= FIAT_REFRESH_INTERVAL
+        try:
+            crypto_ok, fiat_ok = await refresh_prices(with_fiat)
+        except Exception:
+            logging.exception("Price refresh failed")
+            crypto_ok = fiat_ok = False
+        
+        if fiat_ok:
+            last_fiat = time.monotonic()
+        if crypto_ok and (fiat_ok or not with_fiat):
+            failures = 0
+            delay = PRICE_REFRESH_INTERVAL
+        else:
+            failures += 1
+            delay = min(PRICE_REFRESH_INTERVAL * 2 ** failures, PRICE_REFRESH_MAX_BACKOFF)
+        
+        await asyncio.sleep(delay * random.uniform(1 - PRICE_REFRESH_JITTER, 1 + PRICE_REFRESH_JITTER))
+
+# ============== ОБЩИЙ СНАПШОТ (ВОРКЕРЫ) ==============
+# Файл фиксированной структуры: заголовок + слоты крипты + слоты фиата.
+# Загрузчик пишет под seqlock (seq нечётный — идёт запись), воркеры читают без IPC.
+SHM_MAGIC = b"CRSN"
+SHM_LAYOUT = 4
+# magic, layout, seq, version, updated_at, fiat_updated_at, n_crypto, n_fiat, флаги (SHM_RESTORED_*)
+SHM_HEADER = struct.Struct("<4sIQQddIII")
+SHM_RESTORED_CRYPTO = 1
+SHM_RESTORED_FIAT = 2
+SHM_SEQ = struct.Struct("<Q")
+SHM_SEQ_OFFSET = 8
+SHM_COIN_ID_LEN = 48
+SHM_CRYPTO = struct.Struct(f"<{SHM_COIN_ID_LEN}s4d")  # coin_id, usd, rub, eur, usd_24h_change (NaN — нет)
+SHM_FIAT = struct.Struct("<8sd")         # код валюты, курс к USD
+SHM_CRYPTO_SLOTS = 256                   # с запасом на INLINE_SNAPSHOT_TOP
+SHM_FIAT_SLOTS = 256
+SHM_CRYPTO_OFFSET = SHM_HEADER.size
+SHM_FIAT_OFFSET = SHM_CRYPTO_OFFSET + SHM_CRYPTO_SLOTS * SHM_CRYPTO.size
+SHM_SIZE = SHM_FIAT_OFFSET + SHM_FIAT_SLOTS * SHM_FIAT.size
+SHM_CRYPTO_FIELDS = ("usd", "rub", "eur", "usd_24h_change")
+SHM_READ_RETRIES = 100
+
+class SharedSnapshot:
+    """Снапшот цен в mmap-файле: один писатель (загрузчик), читатели — воркеры"""
+
+    def __init__(self, path: str, writable: bool):
+        self.writable = writable
+        with open(path, "r+b" if writable else "rb") as f:
+            self.mm = mmap.mmap(
+                f.fileno(), SHM_SIZE,
+                access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            )
+        magic, layout = struct.unpack_from("<4sI", self.mm, 0)
+        if magic != SHM_MAGIC or layout != SHM_LAYOUT:
+            raise RuntimeError(f"{path} is not a price snapshot file (layout {SHM_LAYOUT})")
+
+    @staticmethod
+    def create(path: str):
+        """Создать пустой файл (если его нет или структура другая)"""
+        try:
+            with open(path, "rb") as f:
+                magic, layout = struct.unpack("<4sI", f.read(8))
+            if magic == SHM_MAGIC and layout == SHM_LAYOUT and os.path.getsize(path) == SHM_SIZE:
+                return
+        except (FileNotFoundError, struct.error):
+            pass
+        with open(path, "wb") as f:
+            f.write(SHM_HEADER.pack(SHM_MAGIC, SHM_LAYOUT, 0, 0, 0.0, 0.0, 0, 0, 0))
+            f.truncate(SHM_SIZE)
+
+    def write(self, snap: PriceSnapshot):
+        # Длинные id в слот не влезут — воркер спросит их через кэш
+        crypto = [item for item in snap.crypto.items() if len(item[0].encode()) <= SHM_COIN_ID_LEN]
+        crypto = crypto[:SHM_CRYPTO_SLOTS]
+        fiat = list(snap.fiat.items())[:SHM_FIAT_SLOTS]
+        seq = SHM_SEQ.unpack_from(self.mm, SHM_SEQ_OFFSET)[0] | 1
+        SHM_SEQ.pack_into(self.mm, SHM_SEQ_OFFSET, seq)
+        
+        for i, (coin_id, info) in enumerate(crypto):
+            values = (info.get(key) for key in SHM_CRYPTO_FIELDS)
+            SHM_CRYPTO.pack_into(
+                self.mm, SHM_CRYPTO_OFFSET + i * SHM_CRYPTO.size, coin_id.encode(),
+                *(float("nan") if v is None else float(v) for v in values)
+            )
+        for i, (code, rate) in enumerate(fiat):
+            SHM_FIAT.pack_into(self.mm, SHM_FIAT_OFFSET + i * SHM_FIAT.size, code.encode(), float(rate))
+        
+        SHM_HEADER.pack_into(
+            self.mm, 0, SHM_MAGIC, SHM_LAYOUT, seq,
+            snap.version, snap.updated_at, snap.fiat_updated_at, len(crypto), len(fiat),
+            SHM_RESTORED_CRYPTO * snap.restored | SHM_RESTORED_FIAT * snap.fiat_restored
+        )
+        SHM_SEQ.pack_into(self.mm, SHM_SEQ_OFFSET, seq + 1)
+
+    def read(self, current: PriceSnapshot) -> PriceSnapshot:
+        """Новый снапшот, если версия в файле сменилась, иначе current"""
+        for _ in range(SHM_READ_RETRIES):
+            seq = SHM_SEQ.unpack_from(self.mm, SHM_SEQ_OFFSET)[0]
+            if seq & 1:
+                continue
+            (_, _, _, version, updated_at, fiat_updated_at,
+             n_crypto, n_fiat, flags) = SHM_HEADER.unpack_from(self.mm, 0)
+            if version == 0 or version == current.version:
+                if SHM_SEQ.unpack_from(self.mm, SHM_SEQ_OFFSET)[0] == seq:
+                    return current
+                continue
+            
+            crypto = {}
+            for i in range(min(n_crypto, SHM_CRYPTO_SLOTS)):
+                raw_id, *values = SHM_CRYPTO.unpack_from(self.mm, SHM_CRYPTO_OFFSET + i * SHM_CRYPTO.size)
+                crypto[raw_id.rstrip(b"\0").decode()] = {
+                    key: v for key, v in zip(SHM_CRYPTO_FIELDS, values) if v == v  # NaN != NaN
+                }
+            fiat = {}
+            for i in range(min(n_fiat, SHM_FIAT_SLOTS)):
+                raw_code, rate = SHM_FIAT.unpack_from(self.mm, SHM_FIAT_OFFSET + i * SHM_FIAT.size)
+                fiat[raw_code.rstrip(b"\0").decode()] = rate
+            
+            if SHM_SEQ.unpack_from(self.mm, SHM_SEQ_OFFSET)[0] == seq:
+                return PriceSnapshot(
+                    version, _freeze(crypto), _freeze(fiat), updated_at, fiat_updated_at,
+                    bool(flags & SHM_RESTORED_CRYPTO), bool(flags & SHM_RESTORED_FIAT)
+                )
+        return current
+
+shared_snapshot: Optional[SharedSnapshot] = None
+
+def attach_shared_snapshot(writable: bool):
+    """Подключить общий файл снапшота; загрузчик продолжает нумерацию версий из файла"""
+    global shared_snapshot, price_snapshot
+    reader = SharedSnapshot(SHARED_SNAPSHOT_PATH, writable=False)
+    price_snapshot = reader.read(price_snapshot)
+    shared_snapshot = SharedSnapshot(SHARED_SNAPSHOT_PATH, writable=True) if writable else reader
+
+# ============== ФОРМАТИРОВАНИЕ ==============
+def format_crypto_price(data: dict, symbol: str, coin_id: Optional[str] = None) -> str:
     """Форматировать цену крипты"""
-    coin_id = CRYPTO_IDS.get(symbol.lower(), symbol.lower())
+    coin_id = coin_id or CRYPTO_IDS.get(symbol.lower(), symbol.lower())
     if coin_id not in data:
         return f"❌ {symbol.upper()} не найден"
     
@@ -158,7 +1618,7 @@ def format_crypto_price(data: dict, symbol: str) -> str:
     usd = info.get("usd", 0)
     rub = info.get("rub", 0)
     eur = info.get("eur", 0)
-    change = info.get("usd_24h_change", 0)
+    change = info.get("usd_24h_change") or 0
     
     emoji = "🟢" if change >= 0 else "🔴"
     
@@ -170,35 +1630,968 @@ def format_crypto_price(data: dict, symbol: str) -> str:
         f"└ 24h: {emoji} <code>{change:+.2f}%</code>"
     )
 
-def format_fiat_rate(rates: dict, currency: str) -> str:
-    """Форматировать курс фиата"""
-    currency = currency.upper()
-    if currency not in rates:
-        return f"❌ {currency} не найден"
-    
-    rate = rates[currency]
-    
-    # Кросс-курсы
-    rub_rate = rates.get("RUB", 0)
-    eur_rate = rates.get("EUR", 0)
+def format_fiat_rate(rates: dict, currency: str) -> str:
+    """Форматировать курс фиата"""
+    currency = currency.upper()
+    if currency not in rates:
+        return f"❌ {currency} не найден"
+    
+    rate = rates[currency]
+    
+    # Кросс-курсы
+    rub_rate = rates.get("RUB", 0)
+    eur_rate = rates.get("EUR", 0)
+    
+    if currency == "USD":
+        return (
+            f"💵 <b>USD (Доллар США)</b>\n"
+            f"├ RUB: <code>₽{rub_rate:,.2f}</code>\n"
+            f"└ EUR: <code>€{eur_rate:,.4f}</code>"
+        )
+    
+    usd_value = 1 / rate if rate else 0
+    rub_value = rub_rate / rate if rate else 0
+    
+    return (
+        f"💵 <b>{currency}</b>\n"
+        f"├ USD: <code>${usd_value:,.4f}</code>\n"
+        f"└ RUB: <code>₽{rub_value:,.2f}</code>"
+    )
+
+# ============== КОНВЕРТЕР ==============
+class CrossRates(NamedTuple):
+    version: int
+    index: Mapping       # код -> строка/столбец матрицы
+    matrix: np.ndarray   # matrix[i, j] — сколько j за 1 i
+    fresh: tuple         # (крипта свежая, фиат свежий) на момент сборки
+
+_cross_rates = CrossRates(0, {}, np.zeros((0, 0)), (False, False))
+
+def cross_rates() -> CrossRates:
+    """Матрица кросс-курсов, пересобирается на версию снапшота или при устаревании половины"""
+    global _cross_rates
+    snap = get_snapshot()
+    fresh = (snapshot_is_fresh(snap), fiat_is_fresh(snap))
+    if _cross_rates.version == snap.version and _cross_rates.fresh == fresh:
+        return _cross_rates
+    
+    # Устаревшая половина в матрицу не попадает: лучше «курсы загружаются», чем старый курс
+    codes, usd = [], []
+    if fresh[0]:
+        for symbol, coin_id in CRYPTO_IDS.items():
+            info = snap.crypto.get(coin_id)
+            if info and info.get("usd"):
+                codes.append(symbol.upper())
+                usd.append(info["usd"])
+    if fresh[1]:
+        for code, rate in snap.fiat.items():
+            if rate and code not in codes:
+                codes.append(code)
+                usd.append(1 / rate)
+    elif codes:
+        # Крипта котируется в долларах — USD доступен и без фиата
+        codes.append("USD")
+        usd.append(1.0)
+    
+    usd = np.array(usd, dtype=np.float64)
+    _cross_rates = CrossRates(
+        snap.version,
+        MappingProxyType({code: i for i, code in enumerate(codes)}),
+        np.divide.outer(usd, usd),
+        fresh
+    )
+    return _cross_rates
+
+def rates_pending(*codes: str) -> bool:
+    """Валюта нам знакома, но её курса пока нет или он устарел"""
+    snap = get_snapshot()
+    if snap.version == 0:
+        return True
+    index = cross_rates().index
+    return any(
+        code not in index and (code.lower() in CRYPTO_IDS or code in FIAT_CURRENCIES or code in snap.fiat)
+        for code in codes
+    )
+
+def convert(amount: float, src: str, dst: str) -> Optional[float]:
+    rates = cross_rates()
+    i, j = rates.index.get(src.upper()), rates.index.get(dst.upper())
+    if i is None or j is None:
+        return None
+    return amount * float(rates.matrix[i, j])
+
+CONVERT_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*([A-Za-z]{2,10})\s+(?:(?:to|in|в)\s+)?([A-Za-z]{2,10})", re.IGNORECASE)
+
+def parse_convert(text: str) -> Optional[tuple[float, str, str]]:
+    """'0.5 BTC UAH' / '0.5 btc to uah' -> (0.5, 'BTC', 'UAH')"""
+    match = CONVERT_RE.fullmatch(text.strip())
+    if not match:
+        return None
+    return float(match.group(1).replace(",", ".")), match.group(2).upper(), match.group(3).upper()
+
+def format_amount(value: float) -> str:
+    """Сумма: 1,234.50 / 0.00001234"""
+    if abs(value) >= 1:
+        return f"{value:,.2f}"
+    return f"{value:.8f}".rstrip("0").rstrip(".")
+
+def format_conversion(amount: float, src: str, dst: str) -> Optional[str]:
+    result = convert(amount, src, dst)
+    if result is None:
+        return None
+    return (
+        f"💱 <b>{format_amount(amount)} {src}</b> = <code>{format_amount(result)} {dst}</code>\n"
+        f"└ 1 {src} = {format_amount(convert(1, src, dst))} {dst}"
+    )
+
+# ============== КАТАЛОГ МОНЕТ ==============
+UNRANKED = 10 ** 9  # ранг монет без капитализации
+
+class CoinCatalog:
+    """Индекс монет: точный тикер, префикс (сортированный массив) и опечатки (symmetric delete)"""
+
+    def __init__(self, coins: list = (), updated_at: float = 0.0):
+        self.updated_at = updated_at
+        # Монеты из CRYPTO_IDS всегда есть и всегда первые для своего тикера
+        merged = {coin_id: (coin_id, symbol, coin_id, -1) for symbol, coin_id in CRYPTO_IDS.items()}
+        for coin_id, symbol, name, rank in coins:
+            if coin_id in merged:
+                merged[coin_id] = (coin_id, symbol, name, -1)
+            elif symbol:
+                merged[coin_id] = (coin_id, symbol.lower(), name, rank if rank else UNRANKED)
+        # Порядок массива = порядок ранжирования, дальше работаем с индексами
+        self.coins = sorted(merged.values(), key=lambda c: (c[3], c[0]))
+        self.symbol_of = {coin_id: symbol for coin_id, symbol, _, _ in self.coins}
+        
+        self.by_symbol: dict[str, list[int]] = {}
+        pairs = []
+        for i, (coin_id, symbol, name, rank) in enumerate(self.coins):
+            self.by_symbol.setdefault(symbol, []).append(i)
+            pairs.append((symbol, i))
+            name = (name or "").lower()
+            if name and name != symbol:
+                pairs.append((name, i))
+        pairs.sort()
+        self._keys = [key for key, _ in pairs]
+        self._key_idx = [i for _, i in pairs]
+        
+        # Короткие префиксы покрывают тысячи ключей — топ для них считаем заранее
+        self._top_short: dict[str, list[int]] = {}
+        for length in (1, 2):
+            groups: dict[str, set[int]] = {}
+            for key, i in pairs:
+                if len(key) >= length:
+                    groups.setdefault(key[:length], set()).add(i)
+            for prefix, idx in groups.items():
+                self._top_short[prefix] = heapq.nsmallest(INLINE_MAX_RESULTS, idx)
+        
+        # Опечатки: тикер и все его варианты без одного символа
+        self._deletes: dict[str, list[str]] = {}
+        for symbol in self.by_symbol:
+            for variant in self._delete_variants(symbol):
+                self._deletes.setdefault(variant, []).append(symbol)
+
+    @staticmethod
+    def _delete_variants(word: str) -> set[str]:
+        variants = {word}
+        if len(word) > 1:
+            variants.update(word[:i] + word[i + 1:] for i in range(len(word)))
+        return variants
+
+    def __len__(self):
+        return len(self.coins)
+
+    def resolve(self, symbol: str, ranked_only: bool = False) -> Optional[str]:
+        """coin_id лучшей по капитализации монеты с таким тикером"""
+        idx = self.by_symbol.get(symbol.lower())
+        if not idx:
+            return None
+        coin_id, _, _, rank = self.coins[idx[0]]
+        if ranked_only and rank >= UNRANKED:
+            return None
+        return coin_id
+
+    def top(self, limit: int) -> list[str]:
+        """coin_id первых limit монет по капитализации (CRYPTO_IDS всегда впереди)"""
+        return [coin_id for coin_id, _, _, rank in self.coins[:limit] if rank < UNRANKED]
+
+    def search(self, query: str, limit: int = INLINE_MAX_RESULTS) -> list[tuple[str, str, str]]:
+        """До limit монет: точный тикер, затем префикс, затем опечатки; внутри — по рангу"""
+        query = query.lower().strip()
+        if not query:
+            return []
+        found: list[int] = list(self.by_symbol.get(query, ()))[:limit]
+        seen = set(found)
+        
+        if len(found) < limit:
+            if len(query) <= 2:
+                prefix_idx = self._top_short.get(query, [])
+            else:
+                lo = bisect.bisect_left(self._keys, query)
+                hi = bisect.bisect_left(self._keys, query + "\uffff")
+                prefix_idx = heapq.nsmallest(limit, set(self._key_idx[lo:hi]))
+            for i in prefix_idx:
+                if i not in seen and len(found) < limit:
+                    found.append(i)
+                    seen.add(i)
+        
+        if len(found) < limit and len(query) >= 2:
+            candidates = set()
+            for variant in self._delete_variants(query):
+                for symbol in self._deletes.get(variant, ()):
+                    candidates.update(self.by_symbol[symbol])
+            for i in heapq.nsmallest(limit, candidates - seen):
+                if len(found) < limit:
+                    found.append(i)
+        
+        return [self.coins[i][:3] for i in found]
+
+coin_catalog = CoinCatalog()
+
+def _read_catalog_file(path: str) -> Optional[CoinCatalog]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    return CoinCatalog(data["coins"], data.get("updated_at", 0.0))
+
+def _write_catalog_file(path: str, catalog: CoinCatalog):
+    data = {"updated_at": catalog.updated_at, "coins": [list(c) for c in catalog.coins]}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+async def load_catalog():
+    """Поднять каталог с диска, чтобы старт не ждал сети"""
+    global coin_catalog
+    try:
+        catalog = await asyncio.to_thread(_read_catalog_file, COINS_CATALOG_PATH)
+    except Exception:
+        logging.exception("Failed to load coin catalogue from %s", COINS_CATALOG_PATH)
+        return
+    if catalog is not None:
+        coin_catalog = catalog
+        logging.info("Coin catalogue loaded: %d coins", len(catalog))
+
+async def fetch_catalog() -> CoinCatalog:
+    """Скачать /coins/list и ранги по капитализации из /coins/markets"""
+    coins = await fetch_json(f"{CRYPTO_API}/coins/list")
+    if not coins:
+        raise RuntimeError("CoinGecko /coins/list returned no data")
+    
+    ranks = {}
+    for page in range(1, COINS_MARKET_PAGES + 1):
+        markets = await fetch_json(
+            f"{CRYPTO_API}/coins/markets?vs_currency=usd&order=market_cap_desc&per_page=250&page={page}"
+        )
+        if not markets:
+            break
+        for coin in markets:
+            if coin.get("market_cap_rank"):
+                ranks[coin["id"]] = coin["market_cap_rank"]
+    
+    entries = [
+        (c["id"], c.get("symbol", ""), c.get("name", ""), ranks.get(c["id"], UNRANKED))
+        for c in coins if c.get("id")
+    ]
+    return await asyncio.to_thread(CoinCatalog, entries, time.time())
+
+async def catalog_refresher():
+    """Фоновая задача: раз в COINS_CATALOG_REFRESH обновляет каталог и сохраняет на диск"""
+    global coin_catalog
+    failures = 0
+    while True:
+        age = time.time() - coin_catalog.updated_at
+        if age < COINS_CATALOG_REFRESH:
+            await asyncio.sleep(COINS_CATALOG_REFRESH - age)
+        try:
+            catalog = await fetch_catalog()
+            coin_catalog = catalog
+            await asyncio.to_thread(_write_catalog_file, COINS_CATALOG_PATH, catalog)
+            logging.info("Coin catalogue refreshed: %d coins", len(catalog))
+            failures = 0
+        except Exception as e:
+            failures += 1
+            logging.warning("Coin catalogue refresh failed: %r", e)
+            await asyncio.sleep(min(60 * 2 ** failures, 3600))
+
+# ============== ИСТОРИЯ ЦЕН ==============
+# Шаг точек (сек) -> длина чанка (сек). Чанк — два BLOB: int64 время и float64 цены
+HISTORY_TIERS = {60: 86400, 3600: 30 * 86400, 86400: 365 * 86400}
+HISTORY_DOWNSAMPLE = ((60, 3600, HISTORY_RAW_KEEP), (3600, 86400, HISTORY_HOURLY_KEEP))
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+def history_symbols() -> list[str]:
+    return [s.upper() for s in CRYPTO_IDS] + list(FIAT_CURRENCIES)
+
+def _chunk_start(ts: int, step: int) -> int:
+    span = HISTORY_TIERS[step]
+    return ts - ts % span
+
+def _pack(ts: np.ndarray, vals: np.ndarray) -> tuple[bytes, bytes]:
+    return ts.astype("<i8").tobytes(), vals.astype("<f8").tobytes()
+
+def _unpack(ts_blob: bytes, vals_blob: bytes) -> tuple[np.ndarray, np.ndarray]:
+    return np.frombuffer(ts_blob, dtype="<i8"), np.frombuffer(vals_blob, dtype="<f8")
+
+async def init_history(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS price_history (
+            symbol TEXT,
+            step INTEGER,
+            chunk_start INTEGER,
+            ts BLOB,
+            vals BLOB,
+            PRIMARY KEY (symbol, step, chunk_start)
+        ) WITHOUT ROWID
+    """)
+
+class PriceHistory:
+    """Минутные точки копятся в памяти и пишутся чанками; старые чанки прореживаются"""
+
+    def __init__(self):
+        # symbol -> [chunk_start, array('q') время, array('d') цены]
+        self.open: dict[str, list] = {}
+        self.dirty: set[str] = set()
+        self.closed: list[tuple[str, int, bytes, bytes]] = []
+
+    async def load_open(self):
+        """Продолжить текущие минутные чанки после рестарта"""
+        start = _chunk_start(int(time.time()), 60)
+        async with db_pool.reader() as db:
+            rows = await _fetch_all(
+                db, "SELECT symbol, ts, vals FROM price_history WHERE step = 60 AND chunk_start = ?",
+                (start,)
+            )
+        for symbol, ts_blob, vals_blob in rows:
+            self.open[symbol] = [start, array.array("q", ts_blob), array.array("d", vals_blob)]
+
+    def append(self, snap: PriceSnapshot):
+        """Слушатель снапшота: одна точка на минуту для каждого символа"""
+        for symbol in history_symbols():
+            value = snapshot_quote(snap, symbol)
+            if value is None:
+                continue
+            # Время — от обновления самой цены: не обновившаяся половина новых точек не даёт
+            ts = int(quote_updated_at(snap, symbol)) // 60 * 60
+            start = _chunk_start(ts, 60)
+            chunk = self.open.get(symbol)
+            if chunk is not None and start < chunk[0]:
+                continue
+            if chunk is not None and chunk[0] != start:
+                self.closed.append((symbol, chunk[0], chunk[1].tobytes(), chunk[2].tobytes()))
+                chunk = None
+            if chunk is None:
+                chunk = self.open[symbol] = [start, array.array("q"), array.array("d")]
+            times, values = chunk[1], chunk[2]
+            if times and times[-1] == ts:
+                values[-1] = value
+            elif not times or times[-1] < ts:
+                times.append(ts)
+                values.append(value)
+            self.dirty.add(symbol)
+
+    async def flush(self):
+        rows = self.closed + [
+            (symbol, self.open[symbol][0], self.open[symbol][1].tobytes(), self.open[symbol][2].tobytes())
+            for symbol in self.dirty
+        ]
+        if not rows:
+            return
+        closed, dirty = self.closed, self.dirty
+        self.closed, self.dirty = [], set()
+        try:
+            async with db_pool.writer() as db:
+                await db.executemany(
+                    "INSERT OR REPLACE INTO price_history (symbol, step, chunk_start, ts, vals) "
+                    "VALUES (?, 60, ?, ?, ?)",
+                    rows
+                )
+        except BaseException:
+            # Запись не прошла — возвращаем чанки, следующий flush повторит
+            self.closed = closed + self.closed
+            self.dirty |= dirty
+            raise
+
+    async def compact(self):
+        """Минутные чанки старше HISTORY_RAW_KEEP -> часовые средние, часовые -> дневные"""
+        for step, target, keep in HISTORY_DOWNSAMPLE:
+            cutoff = int(time.time()) - keep
+            async with db_pool.reader() as db:
+                chunks = await _fetch_all(
+                    db,
+                    "SELECT symbol, chunk_start, ts, vals FROM price_history "
+                    "WHERE step = ? AND chunk_start + ? <= ?",
+                    (step, HISTORY_TIERS[step], cutoff)
+                )
+            for symbol, start, ts_blob, vals_blob in chunks:
+                ts, vals = _unpack(ts_blob, vals_blob)
+                buckets, inverse = np.unique(ts - ts % target, return_inverse=True)
+                means = np.bincount(inverse, weights=vals) / np.bincount(inverse)
+                await self._merge(symbol, target, buckets, means)
+                async with db_pool.writer() as db:
+                    await db.execute(
+                        "DELETE FROM price_history WHERE symbol = ? AND step = ? AND chunk_start = ?",
+                        (symbol, step, start)
+                    )
+
+    async def _merge(self, symbol: str, step: int, ts: np.ndarray, vals: np.ndarray):
+        for start in np.unique(ts - ts % HISTORY_TIERS[step]):
+            mask = (ts >= start) & (ts < start + HISTORY_TIERS[step])
+            async with db_pool.writer() as db:
+                async with db.execute(
+                    "SELECT ts, vals FROM price_history WHERE symbol = ? AND step = ? AND chunk_start = ?",
+                    (symbol, step, int(start))
+                ) as cursor:
+                    row = await cursor.fetchone()
+                new_ts, new_vals = ts[mask], vals[mask]
+                if row:
+                    old_ts, old_vals = _unpack(*row)
+                    new_ts = np.concatenate([old_ts, new_ts])
+                    new_vals = np.concatenate([old_vals, new_vals])
+                    # При совпадении времени берём более позднее значение
+                    new_ts, idx = np.unique(new_ts[::-1], return_index=True)
+                    new_vals = new_vals[::-1][idx]
+                await db.execute(
+                    "INSERT OR REPLACE INTO price_history (symbol, step, chunk_start, ts, vals) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (symbol, step, int(start), *_pack(new_ts, new_vals))
+                )
+
+    async def query(self, symbol: str, since: int) -> tuple[np.ndarray, np.ndarray]:
+        """Все точки символа с момента since, по возрастанию времени"""
+        parts_ts, parts_vals = [], []
+        async with db_pool.reader() as db:
+            for step, span in HISTORY_TIERS.items():
+                rows = await _fetch_all(
+                    db,
+                    "SELECT ts, vals FROM price_history "
+                    "WHERE symbol = ? AND step = ? AND chunk_start > ? ORDER BY chunk_start",
+                    (symbol, step, since - span)
+                )
+                for ts_blob, vals_blob in rows:
+                    ts, vals = _unpack(ts_blob, vals_blob)
+                    parts_ts.append(ts)
+                    parts_vals.append(vals)
+        # Точки, ещё не записанные в БД
+        chunk = self.open.get(symbol)
+        if chunk is not None and chunk[1]:
+            parts_ts.append(np.frombuffer(chunk[1], dtype=np.int64).copy())
+            parts_vals.append(np.frombuffer(chunk[2], dtype=np.float64).copy())
+        if not parts_ts:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        
+        ts = np.concatenate(parts_ts)
+        vals = np.concatenate(parts_vals)
+        ts, idx = np.unique(ts[::-1], return_index=True)
+        vals = vals[::-1][idx]
+        mask = ts >= since
+        return ts[mask], vals[mask]
+
+price_history = PriceHistory()
+
+async def history_maintainer():
+    """Фоновая задача: запись открытых чанков и прореживание старых"""
+    last_compact = 0.0
+    while True:
+        await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+        try:
+            await price_history.flush()
+            if time.monotonic() - last_compact >= HISTORY_COMPACT_INTERVAL:
+                await price_history.compact()
+                last_compact = time.monotonic()
+        except Exception:
+            logging.exception("Price history maintenance failed")
+
+PERIOD_UNITS = {"h": 3600, "d": 86400, "w": 7 * 86400, "m": 30 * 86400, "y": 365 * 86400}
+
+def parse_period(text: str) -> Optional[int]:
+    """'24h', '7d', '2w', '3m', '1y' -> секунды"""
+    match = re.fullmatch(r"(\d+)\s*([hdwmy])", text.strip().lower())
+    if not match:
+        return None
+    seconds = int(match.group(1)) * PERIOD_UNITS[match.group(2)]
+    return seconds if 0 < seconds <= HISTORY_MAX_PERIOD else None
+
+def sparkline(ts: np.ndarray, vals: np.ndarray, points: int = HISTORY_SPARK_POINTS) -> str:
+    grid = np.linspace(ts[0], ts[-1], points)
+    line = np.interp(grid, ts, vals)
+    low, high = line.min(), line.max()
+    if high == low:
+        return SPARK_CHARS[3] * points
+    levels = ((line - low) / (high - low) * (len(SPARK_CHARS) - 1)).round().astype(int)
+    return "".join(SPARK_CHARS[i] for i in levels)
+
+def format_history(symbol: str, period: str, ts: np.ndarray, vals: np.ndarray) -> str:
+    """Мин/макс/средняя/изменение/волатильность за окно"""
+    if len(vals) < 2:
+        return f"📈 <b>{symbol}</b> за {period}\n\nПока мало данных, загляни позже"
+    
+    change = (vals[-1] / vals[0] - 1) * 100 if vals[0] else 0.0
+    # Волатильность — стандартное отклонение лог-доходностей между точками
+    volatility = float(np.std(np.diff(np.log(vals)))) * 100 if (vals > 0).all() else 0.0
+    emoji = "🟢" if change >= 0 else "🔴"
+    return (
+        f"📈 <b>{symbol}</b> за {period}\n"
+        f"<code>{sparkline(ts, vals)}</code>\n"
+        f"├ Сейчас: <code>{format_quote(vals[-1], symbol)}</code>\n"
+        f"├ Мин: <code>{format_quote(vals.min(), symbol)}</code>\n"
+        f"├ Макс: <code>{format_quote(vals.max(), symbol)}</code>\n"
+        f"├ Средняя: <code>{format_quote(vals.mean(), symbol)}</code>\n"
+        f"├ Изменение: {emoji} <code>{change:+.2f}%</code>\n"
+        f"└ Волатильность: <code>{volatility:.2f}%</code> ({len(vals)} точек)"
+    )
+
+# ============== ОТПРАВКА СООБЩЕНИЙ ==============
+class SendScheduler:
+    """Исходящие сообщения в рамках лимитов Telegram.
+
+    Общий token bucket на SEND_GLOBAL_RATE сообщений в секунду, в один чат —
+    не чаще SEND_CHAT_INTERVAL. На RetryAfter ставим на паузу все отправки,
+    а не только упавшую: flood control действует на бота целиком.
+    """
+
+    def __init__(self, rate: float = SEND_GLOBAL_RATE, chat_interval: float = SEND_CHAT_INTERVAL):
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.next_in_chat: dict[int, float] = {}
+        self.lock = asyncio.Lock()
+        self.tasks: set[asyncio.Task] = set()
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retried = 0
+
+    async def _acquire(self, chat_id: int):
+        # Слот в чате бронируем сразу, чтобы параллельные отправки в один чат встали в очередь
+        now = time.monotonic()
+        slot = max(now, self.next_in_chat.get(chat_id, 0.0))
+        self.next_in_chat[chat_id] = slot + self.chat_interval
+        if len(self.next_in_chat) > 10000:
+            self.next_in_chat = {k: v for k, v in self.next_in_chat.items() if v > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> str:
+        """Отправить с учётом лимитов; результат — sent, blocked или failed"""
+        for attempt in range(SEND_MAX_ATTEMPTS):
+            await self._acquire(chat_id)
+            try:
+                await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML, **kwargs)
+                self.sent += 1
+                return "sent"
+            except TelegramRetryAfter as e:
+                self.retried += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                logging.warning("Flood control: pausing sends for %ss", e.retry_after)
+            except TelegramForbiddenError:
+                self.blocked += 1
+                await set_blocked(chat_id, True)
+                return "blocked"
+            except (TelegramNetworkError, TelegramServerError) as e:
+                self.retried += 1
+                logging.warning("Send to %s failed (attempt %d): %r", chat_id, attempt + 1, e)
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logging.warning("Send to %s failed: %r", chat_id, e)
+                break
+        self.failed += 1
+        return "failed"
+
+    def submit(self, chat_id: int, text: str, **kwargs):
+        """Отправить в фоне, не дожидаясь очереди"""
+        task = asyncio.create_task(self.send(chat_id, text, **kwargs))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+sender = SendScheduler()
+
+# ============== АЛЕРТЫ ==============
+async def init_alerts(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS alerts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            symbol TEXT NOT NULL,
+            direction TEXT NOT NULL,
+            threshold REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_alerts_user ON alerts (user_id)")
+
+class AlertIndex:
+    """Пороги алертов по символу в отсортированных массивах.
+
+    Ключ для '>' — минус порог, для '<' — порог: в обоих случаях при цене price
+    срабатывает хвост массива с ключом больше (-price или price), и проверка
+    стоит O(log n + сработавшие).
+    """
+
+    def __init__(self):
+        self.books: dict[tuple[str, str], tuple[list[float], list[int]]] = {}
+        self.alerts: dict[int, tuple[int, str, str, float]] = {}  # id -> (user_id, symbol, direction, threshold)
+        self.max_id = 0
+
+    @staticmethod
+    def _key(direction: str, threshold: float) -> float:
+        return -threshold if direction == ">" else threshold
+
+    def add(self, alert_id: int, user_id: int, symbol: str, direction: str, threshold: float):
+        if alert_id in self.alerts:
+            return
+        keys, ids = self.books.setdefault((symbol, direction), ([], []))
+        i = bisect.bisect_right(keys, self._key(direction, threshold))
+        keys.insert(i, self._key(direction, threshold))
+        ids.insert(i, alert_id)
+        self.alerts[alert_id] = (user_id, symbol, direction, threshold)
+        self.max_id = max(self.max_id, alert_id)
+
+    def remove(self, alert_id: int):
+        alert = self.alerts.pop(alert_id, None)
+        if alert is None:
+            return
+        _, symbol, direction, threshold = alert
+        keys, ids = self.books[(symbol, direction)]
+        key = self._key(direction, threshold)
+        i = bisect.bisect_left(keys, key)
+        while i < len(keys) and keys[i] == key:
+            if ids[i] == alert_id:
+                del keys[i], ids[i]
+                return
+            i += 1
+
+    def evaluate(self, symbol: str, price: float) -> list[tuple[int, tuple]]:
+        """Снять и вернуть сработавшие алерты символа"""
+        fired = []
+        for direction, bound in ((">", -price), ("<", price)):
+            book = self.books.get((symbol, direction))
+            if not book:
+                continue
+            keys, ids = book
+            i = bisect.bisect_right(keys, bound)
+            for alert_id in ids[i:]:
+                fired.append((alert_id, self.alerts.pop(alert_id)))
+            del keys[i:], ids[i:]
+        return fired
+
+    def symbols(self) -> set[str]:
+        return {symbol for (symbol, _), (keys, _) in self.books.items() if keys}
+
+alert_index = AlertIndex()
+
+async def load_alerts(since_id: int = 0):
+    """Загрузить алерты в индекс (все или созданные после since_id)"""
+    async with db_pool.reader() as db:
+        rows = await _fetch_all(
+            db, "SELECT id, user_id, symbol, direction, threshold FROM alerts WHERE id > ? ORDER BY id",
+            (since_id,)
+        )
+    for row in rows:
+        alert_index.add(*row)
+
+async def alert_sync():
+    """Загрузчик: подхватить алерты, созданные воркерами"""
+    while True:
+        await asyncio.sleep(ALERT_SYNC_INTERVAL)
+        try:
+            await load_alerts(alert_index.max_id)
+        except Exception:
+            logging.exception("Alert sync failed")
+
+async def add_alert(user_id: int, symbol: str, direction: str, threshold: float) -> Optional[int]:
+    """Сохранить алерт; None — если у юзера уже ALERTS_PER_USER"""
+    async with db_pool.writer() as db:
+        if await _fetch_value(db, "SELECT COUNT(*) FROM alerts WHERE user_id = ?", (user_id,)) >= ALERTS_PER_USER:
+            return None
+        cursor = await db.execute(
+            "INSERT INTO alerts (user_id, symbol, direction, threshold) VALUES (?, ?, ?, ?)",
+            (user_id, symbol, direction, threshold)
+        )
+        alert_id = cursor.lastrowid
+    # Воркеры не проверяют цены — алерт подхватит загрузчик
+    if PROCESS_ROLE != "worker":
+        alert_index.add(alert_id, user_id, symbol, direction, threshold)
+    return alert_id
+
+async def get_user_alerts(user_id: int):
+    async with db_pool.reader() as db:
+        return await _fetch_all(
+            db, "SELECT id, symbol, direction, threshold FROM alerts WHERE user_id = ? ORDER BY id",
+            (user_id,)
+        )
+
+async def delete_alert(user_id: int, alert_id: int) -> bool:
+    async with db_pool.writer() as db:
+        cursor = await db.execute("DELETE FROM alerts WHERE id = ? AND user_id = ?", (alert_id, user_id))
+        deleted = cursor.rowcount > 0
+    if deleted:
+        alert_index.remove(alert_id)
+    return deleted
+
+# Задачи срабатывания алертов: ссылка держит их от сборщика мусора, on_shutdown дожидается
+alert_tasks: set[asyncio.Task] = set()
+
+# Время цен, по которым алерты уже проверены: (крипта, фиат)
+alerts_checked_at = [0.0, 0.0]
+
+def check_alerts(snap: PriceSnapshot):
+    """Слушатель снапшота: проверить только символы, по которым есть алерты и новые цены"""
+    crypto_new = snap.updated_at > alerts_checked_at[0] and snapshot_is_fresh(snap)
+    fiat_new = snap.fiat_updated_at > alerts_checked_at[1] and fiat_is_fresh(snap)
+    alerts_checked_at[:] = [snap.updated_at, snap.fiat_updated_at]
+    fired = []
+    for symbol in alert_index.symbols():
+        if not (crypto_new if symbol.lower() in CRYPTO_IDS else fiat_new):
+            continue
+        price = snapshot_quote(snap, symbol)
+        if price is not None:
+            fired += [(alert_id, alert, price) for alert_id, alert in alert_index.evaluate(symbol, price)]
+    if fired:
+        task = asyncio.create_task(_fire_alerts(fired))
+        alert_tasks.add(task)
+        task.add_done_callback(alert_tasks.discard)
+
+async def _fire_alerts(fired: list):
+    ids = [alert_id for alert_id, _, _ in fired]
+    placeholders = ",".join("?" * len(ids))
+    # Уведомляем только о реально удалённых: алерт могли удалить в другом процессе
+    try:
+        async with db_pool.writer() as db:
+            async with db.execute(f"DELETE FROM alerts WHERE id IN ({placeholders}) RETURNING id", ids) as cursor:
+                deleted = {row[0] for row in await cursor.fetchall()}
+    except Exception:
+        # Алерты остались в БД — возвращаем в индекс, сработают на следующем снапшоте
+        logging.exception("Failed to fire %d alerts", len(fired))
+        for alert_id, alert, _ in fired:
+            alert_index.add(alert_id, *alert)
+        return
+    
+    # Отправляем внутри задачи алерта, чтобы on_shutdown мог дождаться уведомлений
+    sends = []
+    for alert_id, (user_id, symbol, direction, threshold), price in fired:
+        if alert_id not in deleted:
+            continue
+        word = "выше" if direction == ">" else "ниже"
+        sends.append(sender.send(
+            user_id,
+            f"🔔 <b>{symbol}</b> {word} <code>{format_quote(threshold, symbol)}</code>\n"
+            f"Сейчас: <code>{format_quote(price, symbol)}</code>"
+        ))
+    await asyncio.gather(*sends)
+
+def format_alerts(alerts: list) -> tuple[str, InlineKeyboardMarkup]:
+    if not alerts:
+        text = "🔔 <b>Алерты</b>\n\nАлертов нет. Создай: <code>/alert BTC &gt; 70000</code>"
+    else:
+        text = "🔔 <b>Алерты</b>\n\n" + "".join(
+            f"#{alert_id} {symbol} {'&gt;' if direction == '>' else '&lt;'} "
+            f"<code>{format_quote(threshold, symbol)}</code>\n"
+            for alert_id, symbol, direction, threshold in alerts
+        )
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"❌ #{alert_id} {symbol} {direction} {threshold:g}",
+                              callback_data=f"alert_del:{alert_id}")]
+        for alert_id, symbol, direction, threshold in alerts
+    ])
+    return text, kb
+
+# ============== РАССЫЛКИ ==============
+async def init_broadcasts(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'draft',
+            chat_id INTEGER,
+            message_id INTEGER,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    """)
+
+BROADCAST_COLUMNS = "id, admin_id, text, status, chat_id, message_id, last_user_id, total, sent, failed, blocked"
+
+class Broadcast(NamedTuple):
+    id: int
+    admin_id: int
+    text: str
+    status: str
+    chat_id: Optional[int]
+    message_id: Optional[int]
+    last_user_id: int
+    total: int
+    sent: int
+    failed: int
+    blocked: int
+
+async def get_broadcast(broadcast_id: int) -> Optional[Broadcast]:
+    async with db_pool.reader() as db:
+        rows = await _fetch_all(db, f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id = ?", (broadcast_id,))
+    return Broadcast(*rows[0]) if rows else None
+
+async def create_broadcast(admin_id: int, text: str) -> int:
+    async with db_pool.writer() as db:
+        cursor = await db.execute("INSERT INTO broadcasts (admin_id, text) VALUES (?, ?)", (admin_id, text))
+        return cursor.lastrowid
+
+async def set_broadcast_status(broadcast_id: int, status: str, expected: str) -> bool:
+    """Сменить статус, только если он всё ещё expected (переходы из разных процессов)"""
+    async with db_pool.writer() as db:
+        cursor = await db.execute(
+            "UPDATE broadcasts SET status = ?, "
+            "finished_at = CASE WHEN ? IN ('done', 'cancelled') THEN CURRENT_TIMESTAMP END "
+            "WHERE id = ? AND status = ?",
+            (status, status, broadcast_id, expected)
+        )
+        return cursor.rowcount > 0
+
+BROADCAST_RECIPIENTS_SQL = (
+    "SELECT user_id FROM users WHERE user_id > ? AND is_banned = 0 AND is_blocked = 0 "
+    "ORDER BY user_id LIMIT ?"
+)
+
+def format_broadcast(job: Broadcast, rate: float = 0.0) -> tuple[str, Optional[InlineKeyboardMarkup]]:
+    titles = {
+        "draft": "📝 Черновик",
+        "running": "⏳ Идёт",
+        "done": "✅ Завершена",
+        "cancelled": "⏹ Остановлена",
+    }
+    text = f"📢 <b>Рассылка #{job.id}</b> — {titles.get(job.status, job.status)}\n\n"
+    if job.status == "draft":
+        text += f"{job.text}\n\n<i>Отправить всем юзерам?</i>"
+        kb = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="🚀 Отправить", callback_data=f"bc:start:{job.id}"),
+            InlineKeyboardButton(text="❌ Отмена", callback_data=f"bc:cancel:{job.id}")
+        ]])
+        return text, kb
     
-    if currency == "USD":
-        return (
-            f"💵 <b>USD (Доллар США)</b>\n"
-            f"├ RUB: <code>₽{rub_rate:,.2f}</code>\n"
-            f"└ EUR: <code>€{eur_rate:,.4f}</code>"
-        )
+    done = job.sent + job.failed + job.blocked
+    percent = done / job.total * 100 if job.total else 100
+    text += (
+        f"├ Прогресс: <code>{done}/{job.total}</code> ({percent:.0f}%)\n"
+        f"├ Доставлено: <code>{job.sent}</code>\n"
+        f"├ Ошибок: <code>{job.failed}</code>\n"
+        f"└ Заблокировали бота: <code>{job.blocked}</code>"
+    )
+    if job.status == "running":
+        text += f"\n\n⚡ {rate:.1f} сообщ./сек"
+        kb = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="⏹ Остановить", callback_data=f"bc:cancel:{job.id}")
+        ]])
+        return text, kb
+    return text, None
+
+async def _show_broadcast_progress(job: Broadcast, rate: float = 0.0):
+    if not job.chat_id:
+        return
+    text, kb = format_broadcast(job, rate)
+    try:
+        await bot.edit_message_text(text, chat_id=job.chat_id, message_id=job.message_id,
+                                    reply_markup=kb, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logging.warning("Failed to update broadcast #%d progress: %r", job.id, e)
+
+async def run_broadcast(broadcast_id: int):
+    """Разослать постранично по user_id; после каждой страницы — чекпоинт в БД.
+
+    После перезапуска рассылка продолжается с last_user_id, так что повторно
+    сообщение может получить максимум одна недоотправленная страница.
+    """
+    job = await get_broadcast(broadcast_id)
+    started, sent_at_start = time.monotonic(), job.sent + job.failed + job.blocked
+    last_progress = 0.0
+    logging.info("Broadcast #%d running from user_id > %d", job.id, job.last_user_id)
     
-    usd_value = 1 / rate if rate else 0
-    rub_value = rub_rate / rate if rate else 0
+    while True:
+        async with db_pool.reader() as db:
+            users = [row[0] for row in await _fetch_all(
+                db, BROADCAST_RECIPIENTS_SQL, (job.last_user_id, BROADCAST_PAGE_SIZE)
+            )]
+        if not users:
+            break
+        
+        results = await asyncio.gather(*(sender.send(user_id, job.text) for user_id in users))
+        async with db_pool.writer() as db:
+            cursor = await db.execute(
+                "UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, failed = failed + ?, "
+                "blocked = blocked + ? WHERE id = ? AND status = 'running'",
+                (users[-1], results.count("sent"), results.count("failed"), results.count("blocked"), job.id)
+            )
+            still_running = cursor.rowcount > 0
+        job = await get_broadcast(broadcast_id)
+        if not still_running:
+            # Остановили кнопкой (возможно, в другом процессе)
+            break
+        
+        now = time.monotonic()
+        if now - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+            last_progress = now
+            done = job.sent + job.failed + job.blocked
+            await _show_broadcast_progress(job, (done - sent_at_start) / (now - started))
     
-    return (
-        f"💵 <b>{currency}</b>\n"
-        f"├ USD: <code>${usd_value:,.4f}</code>\n"
-        f"└ RUB: <code>₽{rub_value:,.2f}</code>"
-    )
+    if job.status == "running":
+        await set_broadcast_status(job.id, "done", "running")
+        job = job._replace(status="done")
+    logging.info("Broadcast #%d %s: sent=%d failed=%d blocked=%d",
+                 job.id, job.status, job.sent, job.failed, job.blocked)
+    await _show_broadcast_progress(job)
+
+# Рассылки выполняет только загрузчик (или единственный процесс): у каждой ровно один исполнитель
+broadcast_tasks: dict[int, asyncio.Task] = {}
+
+def start_broadcast_task(broadcast_id: int):
+    if broadcast_id in broadcast_tasks:
+        return
+    task = asyncio.create_task(run_broadcast(broadcast_id))
+    broadcast_tasks[broadcast_id] = task
+    task.add_done_callback(lambda _: broadcast_tasks.pop(broadcast_id, None))
+    background_tasks.append(task)
+
+async def resume_broadcasts():
+    """Запустить рассылки в статусе running: прерванные перезапуском и запущенные из воркеров"""
+    async with db_pool.reader() as db:
+        rows = await _fetch_all(db, "SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+    for broadcast_id, in rows:
+        start_broadcast_task(broadcast_id)
+
+async def broadcast_sync():
+    """Загрузчик: воркеры только переводят рассылку в running, отправляет загрузчик"""
+    while True:
+        await asyncio.sleep(BROADCAST_SYNC_INTERVAL)
+        try:
+            await resume_broadcasts()
+        except Exception:
+            logging.exception("Broadcast sync failed")
 
 # ============== КЛАВИАТУРЫ ==============
+# Статичные клавиатуры собираются один раз
+@functools.cache
 def get_main_keyboard() -> InlineKeyboardMarkup:
     buttons = [
         [
@@ -209,6 +2602,7 @@ def get_main_keyboard() -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+@functools.cache
 def get_crypto_keyboard() -> InlineKeyboardMarkup:
     buttons = []
     row = []
@@ -222,6 +2616,7 @@ def get_crypto_keyboard() -> InlineKeyboardMarkup:
     buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="menu_main")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+@functools.cache
 def get_fiat_keyboard() -> InlineKeyboardMarkup:
     buttons = []
     row = []
@@ -235,16 +2630,267 @@ def get_fiat_keyboard() -> InlineKeyboardMarkup:
     buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="menu_main")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+@functools.cache
 def get_admin_keyboard() -> InlineKeyboardMarkup:
     buttons = [
-        [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="👥 Список юзеров", callback_data="admin_users")],
-        [InlineKeyboardButton(text="📥 Скачать .txt", callback_data="admin_download")],
+        [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats"),
+         InlineKeyboardButton(text="📈 Метрики", callback_data="admin_metrics")],
+        [InlineKeyboardButton(text="👥 Список юзеров", callback_data="admin_users"),
+         InlineKeyboardButton(text="🏆 Топ символов", callback_data="admin_top:7")],
+        [InlineKeyboardButton(text="📥 Скачать .txt", callback_data="admin_download"),
+         InlineKeyboardButton(text="📥 Лог запросов", callback_data="admin_download_requests")],
+        [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
         [InlineKeyboardButton(text="🚫 Забанить", callback_data="admin_ban"),
          InlineKeyboardButton(text="✅ Разбанить", callback_data="admin_unban")]
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+# ============== КАРТОЧКИ ЦЕН ==============
+REFRESH_BUTTON_TEXT = "🔄 Обновить"
+
+class Rendered(NamedTuple):
+    text: str
+    markup: InlineKeyboardMarkup
+    digest: int          # хэш содержимого: совпал — редактировать нечего
+
+def _make_card(text: str, refresh_data: str, back_data: str) -> Rendered:
+    markup = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=REFRESH_BUTTON_TEXT, callback_data=refresh_data)],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data=back_data)]
+    ])
+    return Rendered(text, markup, hash((text, refresh_data, back_data)))
+
+class RenderCache:
+    """Готовые карточки на одну версию снапшота; новая версия сбрасывает всё разом.
+
+    Данные не из снапшота (фолбэк через price_cache) приходят с версией 0 и не кэшируются.
+    """
+
+    def __init__(self, max_keys: int = RENDER_CACHE_MAX_KEYS):
+        self.max_keys = max_keys
+        self.version = 0
+        self.cards: dict[str, Rendered] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, version: int, render) -> Rendered:
+        if version > self.version:
+            self.version = version
+            self.cards = {}
+        elif version < self.version:
+            version = 0          # воркер прочитал снапшот старее уже закэшированного
+        card = self.cards.get(key) if version else None
+        if card is not None:
+            self.hits += 1
+            return card
+        self.misses += 1
+        card = render()
+        if version and len(self.cards) < self.max_keys:
+            self.cards[key] = card
+        return card
+
+render_cache = RenderCache()
+
+async def render_crypto_card(symbol: str) -> Rendered:
+    snap = get_snapshot()
+    data = await current_crypto_prices([symbol])
+    return render_cache.get(
+        f"crypto:{symbol}", snap.version if data is snap.crypto else 0,
+        lambda: _make_card(format_crypto_price(data, symbol), f"crypto_{symbol}", "menu_crypto")
+    )
+
+async def render_fiat_card(currency: str) -> Rendered:
+    snap = get_snapshot()
+    rates = await current_fiat_rates()
+    return render_cache.get(
+        f"fiat:{currency}", snap.version if rates is snap.fiat else 0,
+        lambda: _make_card(format_fiat_rate(rates, currency), f"fiat_{currency}", "menu_fiat")
+    )
+
+class MessageRenders:
+    """Какая карточка показана в сообщении и когда её обновляли.
+
+    LRU по (chat_id, message_id) в OrderedDict: при переполнении вытесняем
+    самые давние. Хранится только для сообщений-карточек.
+    """
+
+    def __init__(self, max_keys: int = RENDER_MESSAGES_MAX_KEYS):
+        self.max_keys = max_keys
+        self.shown: OrderedDict = OrderedDict()   # ключ -> (digest, time.monotonic())
+        self.edited = 0
+        self.unchanged = 0
+        self.debounced = 0
+
+    def get(self, key: tuple) -> Optional[tuple[int, float]]:
+        entry = self.shown.get(key)
+        if entry is not None:
+            self.shown.move_to_end(key)
+        return entry
+
+    def remember(self, key: tuple, digest: int, now: float):
+        self.shown[key] = (digest, now)
+        self.shown.move_to_end(key)
+        if len(self.shown) > self.max_keys:
+            self.shown.popitem(last=False)
+
+message_renders = MessageRenders()
+
+def _shows_card(message: Message, refresh_data: str) -> bool:
+    """Сообщение уже показывает эту карточку — нажали «🔄 Обновить», а не кнопку меню"""
+    markup = message.reply_markup
+    if not markup or not markup.inline_keyboard:
+        return False
+    first_row = markup.inline_keyboard[0]
+    return (
+        len(first_row) == 1
+        and first_row[0].text == REFRESH_BUTTON_TEXT
+        and first_row[0].callback_data == refresh_data
+    )
+
+async def show_price_card(callback: CallbackQuery, refresh_data: str, render, *args) -> bool:
+    """Показать карточку в сообщении колбэка без лишних editMessageText.
+
+    False — нажатие погашено дребезгом, карточку не строили.
+    """
+    message = callback.message
+    key = (message.chat.id, message.message_id)
+    now = time.monotonic()
+    # Кнопки меню (тот же callback_data) всегда перерисовывают сообщение
+    shown = message_renders.get(key) if _shows_card(message, refresh_data) else None
+    if shown is not None and now - shown[1] < REFRESH_DEBOUNCE:
+        message_renders.debounced += 1
+        await callback.answer()
+        return False
+    
+    card = await render(*args)
+    if shown is not None and shown[0] == card.digest:
+        message_renders.unchanged += 1
+        message_renders.remember(key, card.digest, now)
+        await callback.answer("Цена не изменилась")
+        return True
+    
+    try:
+        await message.edit_text(card.text, reply_markup=card.markup, parse_mode=ParseMode.HTML)
+    except TelegramBadRequest as e:
+        # Другой процесс/рестарт: хэша не помним, а в сообщении уже то же самое
+        if "message is not modified" not in str(e):
+            raise
+        message_renders.unchanged += 1
+        message_renders.remember(key, card.digest, now)
+        await callback.answer("Цена не изменилась")
+        return True
+    message_renders.edited += 1
+    message_renders.remember(key, card.digest, now)
+    await callback.answer()
+    return True
+
+# ============== АНТИФЛУД ==============
+class ThrottleBucket:
+    __slots__ = ("tokens", "updated", "strikes", "strike_start", "notified")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+        self.strikes = 0
+        self.strike_start = now
+        self.notified = False
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Token bucket на (юзер, тип апдейта) до любых хендлеров и обращений к БД.
+
+    Корзины лежат в OrderedDict в порядке последнего обращения: вытесняем с
+    начала — и простаивающие дольше THROTTLE_IDLE_TTL, и сверх THROTTLE_MAX_KEYS.
+    Кто упорно долбит в лимит, получает временный бан (в памяти процесса);
+    баны одной длины, так что в OrderedDict они лежат в порядке истечения.
+    """
+
+    def __init__(self, limits: dict = THROTTLE_LIMITS):
+        self.limits = limits
+        self.buckets: OrderedDict = OrderedDict()
+        self.temp_bans: OrderedDict = OrderedDict()   # user_id -> monotonic окончания бана
+        self.rejected = 0
+
+    def _evict(self, now: float):
+        buckets = self.buckets
+        while buckets:
+            bucket = next(iter(buckets.values()))
+            if len(buckets) <= THROTTLE_MAX_KEYS and now - bucket.updated < THROTTLE_IDLE_TTL:
+                break
+            buckets.popitem(last=False)
+
+    def _expire_bans(self, now: float):
+        bans = self.temp_bans
+        while bans and (next(iter(bans.values())) <= now or len(bans) > THROTTLE_MAX_KEYS):
+            bans.popitem(last=False)
+
+    def _allow(self, user_id: int, event_type: str, now: float) -> tuple[bool, Optional[ThrottleBucket]]:
+        limit = self.limits.get(event_type)
+        if limit is None:
+            return True, None
+        rate, burst = limit
+        key = (user_id, event_type)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = ThrottleBucket(burst, now)
+            self._evict(now)
+        else:
+            self.buckets.move_to_end(key)
+            bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+        
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.notified = False
+            return True, bucket
+        
+        self.rejected += 1
+        if now - bucket.strike_start > THROTTLE_STRIKE_WINDOW:
+            bucket.strike_start, bucket.strikes = now, 0
+        bucket.strikes += 1
+        if THROTTLE_BAN_STRIKES and bucket.strikes >= THROTTLE_BAN_STRIKES:
+            self.temp_bans[user_id] = now + THROTTLE_BAN_DURATION
+            self.temp_bans.move_to_end(user_id)
+            bucket.strikes = 0
+            bucket.notified = False
+            logging.warning("User %s temporarily banned for flooding (%s)", user_id, event_type)
+        return False, bucket
+
+    async def __call__(self, handler, event: Update, data: dict):
+        user = data.get("event_from_user")
+        if user is None or user.id in ADMIN_IDS:
+            return await handler(event, data)
+        
+        now = time.monotonic()
+        self._expire_bans(now)
+        if user.id in self.temp_bans:
+            # Молча: кнопке нужен ответ, иначе у юзера крутится индикатор загрузки
+            if event.callback_query:
+                await event.callback_query.answer()
+            return None
+        
+        allowed, bucket = self._allow(user.id, event.event_type, now)
+        if allowed:
+            return await handler(event, data)
+        
+        # Отвечаем один раз за серию отказов, чтобы флуд не превращался в исходящий флуд
+        if bucket.notified:
+            if event.callback_query:
+                await event.callback_query.answer()
+            return None
+        bucket.notified = True
+        text = (
+            f"🚫 Слишком много запросов, подожди {THROTTLE_BAN_DURATION // 60} мин."
+            if user.id in self.temp_bans else "🐢 Помедленнее, слишком много запросов"
+        )
+        if event.callback_query:
+            await event.callback_query.answer(text)
+        elif event.message:
+            await event.message.answer(text)
+        return None
+
+throttling = ThrottlingMiddleware()
+dp.update.outer_middleware(throttling)
+
 # ============== ХЕНДЛЕРЫ ==============
 @router.message(CommandStart())
 async def cmd_start(message: Message):
@@ -252,6 +2898,7 @@ async def cmd_start(message: Message):
         return await message.answer("🚫 Вы заблокированы")
     
     await add_user(message.from_user.id, message.from_user.username, message.from_user.first_name)
+    await set_blocked(message.from_user.id, False)
     
     text = (
         f"👋 Привет, <b>{message.from_user.first_name}</b>!\n\n"
@@ -279,9 +2926,13 @@ async def cmd_help(message: Message):
         "/start - Главное меню\n"
         "/help - Эта справка\n"
         "/rate BTC - Курс криптовалюты\n"
-        "/rate USD - Курс фиатной валюты\n\n"
+        "/rate USD - Курс фиатной валюты\n"
+        "/history BTC 7d - История курса\n"
+        "/convert 0.5 BTC UAH - Конвертер\n"
+        "/alert BTC &gt; 70000 - Уведомить о цене\n"
+        "/alerts - Мои алерты\n\n"
         "<b>Инлайн режим:</b>\n"
-        f"Напиши <code>@{(await bot.me()).username} BTC</code> в любом чате\n\n"
+        f"Напиши <code>@{bot_username} BTC</code> в любом чате\n\n"
         "<b>Поддерживаемые крипты:</b>\n"
         f"{', '.join(s.upper() for s in CRYPTO_IDS.keys())}\n\n"
         "<b>Поддерживаемые валюты:</b>\n"
@@ -303,17 +2954,121 @@ async def cmd_rate(message: Message):
     symbol = args[1].strip().upper()
     await log_request(message.from_user.id, "command", symbol)
     
-    # Проверяем крипта или фиат
+    # Проверяем крипта или фиат, потом — весь каталог монет
     if symbol.lower() in CRYPTO_IDS:
-        data = await get_crypto_prices([symbol])
+        data = await current_crypto_prices([symbol])
         text = format_crypto_price(data, symbol)
     else:
-        rates = await get_fiat_rates()
-        text = format_fiat_rate(rates, symbol)
+        rates = await current_fiat_rates()
+        coin_id = coin_catalog.resolve(symbol) if symbol not in rates else None
+        if coin_id:
+            data = await current_crypto_prices([coin_id])
+            text = format_crypto_price(data, symbol, coin_id)
+        else:
+            text = format_fiat_rate(rates, symbol)
+    
+    await message.answer(text, parse_mode=ParseMode.HTML)
+
+@router.message(Command("history"))
+async def cmd_history(message: Message):
+    if await is_banned(message.from_user.id):
+        return
+    
+    await add_user(message.from_user.id, message.from_user.username, message.from_user.first_name)
+    
+    args = message.text.split()
+    if len(args) < 2:
+        return await message.answer("❌ Укажи валюту и период: /history BTC 7d")
+    
+    symbol = args[1].upper()
+    period = args[2].lower() if len(args) > 2 else "24h"
+    seconds = parse_period(period)
+    if symbol not in history_symbols():
+        return await message.answer(f"❌ История есть только для: {', '.join(history_symbols())}")
+    if seconds is None:
+        return await message.answer("❌ Период: 24h, 7d, 2w, 3m, 1y")
+    
+    await log_request(message.from_user.id, "history", symbol)
+    ts, vals = await price_history.query(symbol, int(time.time()) - seconds)
+    await message.answer(format_history(symbol, period, ts, vals), parse_mode=ParseMode.HTML)
+
+@router.message(Command("convert"))
+async def cmd_convert(message: Message):
+    if await is_banned(message.from_user.id):
+        return
+    
+    await add_user(message.from_user.id, message.from_user.username, message.from_user.first_name)
     
+    args = message.text.split(maxsplit=1)
+    parsed = parse_convert(args[1]) if len(args) > 1 else None
+    if not parsed:
+        return await message.answer("❌ Формат: /convert 0.5 BTC UAH")
+    
+    amount, src, dst = parsed
+    await log_request(message.from_user.id, "convert", f"{src}/{dst}")
+    text = format_conversion(amount, src, dst)
+    if text is None:
+        if rates_pending(src, dst):
+            return await message.answer("⏳ Курсы ещё загружаются, попробуй через минуту")
+        return await message.answer(f"❌ Не знаю курс {src} или {dst}")
     await message.answer(text, parse_mode=ParseMode.HTML)
 
-@router.message(F.text)
+@router.message(Command("alert"))
+async def cmd_alert(message: Message):
+    if await is_banned(message.from_user.id):
+        return
+    
+    await add_user(message.from_user.id, message.from_user.username, message.from_user.first_name)
+    
+    args = message.text.split(maxsplit=1)
+    match = re.fullmatch(r"([A-Za-z]+)\s*([<>])\s*(\d+(?:[.,]\d+)?)", args[1].strip()) if len(args) > 1 else None
+    if not match:
+        return await message.answer("❌ Формат: /alert BTC &gt; 70000 или /alert EUR &lt; 1.05", parse_mode=ParseMode.HTML)
+    
+    symbol, direction = match.group(1).upper(), match.group(2)
+    threshold = float(match.group(3).replace(",", "."))
+    if symbol not in history_symbols():
+        return await message.answer(f"❌ Алерты есть только для: {', '.join(history_symbols())}")
+    
+    await log_request(message.from_user.id, "alert", symbol)
+    alert_id = await add_alert(message.from_user.id, symbol, direction, threshold)
+    if alert_id is None:
+        return await message.answer(f"❌ Не больше {ALERTS_PER_USER} алертов. Удали лишние: /alerts")
+    
+    price = snapshot_quote(get_snapshot(), symbol)
+    now = f"\nСейчас: <code>{format_quote(price, symbol)}</code>" if price is not None else ""
+    await message.answer(
+        f"🔔 Алерт #{alert_id}: <b>{symbol}</b> {'выше' if direction == '>' else 'ниже'} "
+        f"<code>{format_quote(threshold, symbol)}</code>{now}",
+        parse_mode=ParseMode.HTML
+    )
+
+@router.message(Command("alerts"))
+async def cmd_alerts(message: Message):
+    if await is_banned(message.from_user.id):
+        return
+    
+    text, kb = format_alerts(await get_user_alerts(message.from_user.id))
+    await message.answer(text, reply_markup=kb, parse_mode=ParseMode.HTML)
+
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    args = message.html_text.split(maxsplit=1)
+    if len(args) < 2:
+        return await message.answer(
+            "📢 Формат: <code>/broadcast текст</code> — HTML-разметка сохраняется",
+            parse_mode=ParseMode.HTML
+        )
+    
+    job = await get_broadcast(await create_broadcast(message.from_user.id, args[1]))
+    text, kb = format_broadcast(job)
+    await message.answer(text, reply_markup=kb, parse_mode=ParseMode.HTML)
+
+# Команды, которые не поймали хендлеры выше, — не символы валют
+@router.message(F.text & ~F.text.startswith("/"))
 async def handle_text(message: Message):
     if await is_banned(message.from_user.id):
         return
@@ -325,14 +3080,20 @@ async def handle_text(message: Message):
     # Проверяем это запрос курса или нет
     if symbol.lower() in CRYPTO_IDS:
         await log_request(message.from_user.id, "text", symbol)
-        data = await get_crypto_prices([symbol])
+        data = await current_crypto_prices([symbol])
         text = format_crypto_price(data, symbol)
         await message.answer(text, parse_mode=ParseMode.HTML)
     elif symbol in FIAT_CURRENCIES:
         await log_request(message.from_user.id, "text", symbol)
-        rates = await get_fiat_rates()
+        rates = await current_fiat_rates()
         text = format_fiat_rate(rates, symbol)
         await message.answer(text, parse_mode=ParseMode.HTML)
+    elif coin_id := coin_catalog.resolve(symbol, ranked_only=True):
+        # Только монеты с капитализацией, чтобы не отвечать на обычные слова
+        await log_request(message.from_user.id, "text", symbol)
+        data = await current_crypto_prices([coin_id])
+        text = format_crypto_price(data, symbol, coin_id)
+        await message.answer(text, parse_mode=ParseMode.HTML)
 
 # ============== CALLBACK HANDLERS ==============
 @router.callback_query(F.data == "menu_main")
@@ -361,13 +3122,12 @@ async def cb_menu_fiat(callback: CallbackQuery):
 
 @router.callback_query(F.data == "menu_help")
 async def cb_menu_help(callback: CallbackQuery):
-    bot_info = await bot.me()
     text = (
         "📖 <b>Как пользоваться</b>\n\n"
         "1️⃣ Выбери категорию (Крипта/Валюты)\n"
         "2️⃣ Нажми на нужную валюту\n"
         "3️⃣ Или напиши символ в чат (BTC, USD)\n\n"
-        f"💡 <b>Инлайн:</b> @{bot_info.username} BTC"
+        f"💡 <b>Инлайн:</b> @{bot_username} BTC"
     )
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔙 Назад", callback_data="menu_main")]
@@ -377,29 +3137,24 @@ async def cb_menu_help(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("crypto_"))
 async def cb_crypto(callback: CallbackQuery):
     symbol = callback.data.replace("crypto_", "")
-    await log_request(callback.from_user.id, "button", symbol)
-    
-    data = await get_crypto_prices([symbol])
-    text = format_crypto_price(data, symbol)
-    
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data=f"crypto_{symbol}")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="menu_crypto")]
-    ])
-    await callback.message.edit_text(text, reply_markup=kb, parse_mode=ParseMode.HTML)
+    if await show_price_card(callback, callback.data, render_crypto_card, symbol):
+        await log_request(callback.from_user.id, "button", symbol)
 
 @router.callback_query(F.data.startswith("fiat_"))
 async def cb_fiat(callback: CallbackQuery):
     currency = callback.data.replace("fiat_", "")
-    await log_request(callback.from_user.id, "button", currency)
-    
-    rates = await get_fiat_rates()
-    text = format_fiat_rate(rates, currency)
+    if await show_price_card(callback, callback.data, render_fiat_card, currency):
+        await log_request(callback.from_user.id, "button", currency)
+
+@router.callback_query(F.data.startswith("alert_del:"))
+async def cb_alert_delete(callback: CallbackQuery):
+    alert_id = callback.data.split(":", 1)[1]
+    if alert_id.isdigit() and await delete_alert(callback.from_user.id, int(alert_id)):
+        await callback.answer(f"Алерт #{alert_id} удалён")
+    else:
+        await callback.answer("Алерт уже удалён")
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data=f"fiat_{currency}")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="menu_fiat")]
-    ])
+    text, kb = format_alerts(await get_user_alerts(callback.from_user.id))
     await callback.message.edit_text(text, reply_markup=kb, parse_mode=ParseMode.HTML)
 
 # ============== ADMIN CALLBACKS ==============
@@ -409,61 +3164,165 @@ async def cb_admin_stats(callback: CallbackQuery):
         return await callback.answer("⛔ Нет доступа", show_alert=True)
     
     stats = await get_stats()
+    cache = price_cache.stats()
     text = (
         "📊 <b>Статистика</b>\n\n"
         f"👥 Всего юзеров: <code>{stats['total']}</code>\n"
         f"🆕 За сегодня: <code>{stats['today']}</code>\n"
         f"🚫 Забанено: <code>{stats['banned']}</code>\n"
-        f"📨 Запросов: <code>{stats['requests']}</code>"
+        f"📨 Запросов: <code>{stats['requests']}</code>\n"
+    )
+    if stats["requests_by_type"]:
+        text += "\n<b>Запросы сегодня:</b>\n" + "".join(
+            f"• {request_type or '—'}: <code>{count}</code>\n"
+            for request_type, count in stats["requests_by_type"]
+        )
+    if stats["requests_by_day"]:
+        text += "\n<b>Запросы по дням:</b>\n" + "".join(
+            f"• {day}: <code>{count}</code>\n" for day, count in stats["requests_by_day"]
+        )
+    text += (
+        "\n"
+        f"🗄 Кэш цен: hit <code>{cache['hits'] + cache['stale_hits']}</code> | "
+        f"miss <code>{cache['misses']}</code> | "
+        f"coalesced <code>{cache['coalesced']}</code>"
     )
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
     ])
     await callback.message.edit_text(text, reply_markup=kb, parse_mode=ParseMode.HTML)
 
-@router.callback_query(F.data == "admin_users")
-async def cb_admin_users(callback: CallbackQuery):
+@router.callback_query(F.data == "admin_metrics")
+async def cb_admin_metrics(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         return await callback.answer("⛔ Нет доступа", show_alert=True)
     
-    users = await get_all_users()
-    text = "👥 <b>Пользователи</b>\n\n"
+    text = f"📈 <b>Метрики</b> (процесс {PROCESS_ROLE}, p50 / p95 / p99 в мс)\n"
+    for title, name in (("Хендлеры", "bot_handler_seconds"), ("Внешние API", "bot_upstream_seconds"),
+                        ("БД", "bot_db_seconds"), ("Bot API", "bot_api_seconds")):
+        rows = metrics.summary(name)
+        if rows:
+            text += f"\n<b>{title}:</b>\n" + "".join(
+                f"• {label} ×{count}: <code>{p50 * 1000:.1f} / {p95 * 1000:.1f} / {p99 * 1000:.1f}</code>\n"
+                for label, count, p50, p95, p99 in rows
+            )
+    cache = price_cache.stats()
+    lookups = cache["hits"] + cache["stale_hits"] + cache["misses"]
+    hit_rate = (cache["hits"] + cache["stale_hits"]) / lookups * 100 if lookups else 0
+    text += (
+        "\n"
+        f"🗄 Кэш цен: hit rate <code>{hit_rate:.0f}%</code> из <code>{lookups}</code>\n"
+        f"📥 Очередь лога: <code>{request_log.queue.qsize()}</code> | "
+        f"📤 отправка: <code>{len(sender.tasks)}</code> | "
+        f"🐢 отклонено: <code>{throttling.rejected}</code>"
+    )
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_metrics"),
+         InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
+    ])
+    await callback.message.edit_text(text, reply_markup=kb, parse_mode=ParseMode.HTML)
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("admin_top:"))
+async def cb_admin_top(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("⛔ Нет доступа", show_alert=True)
     
-    for user in users[:20]:  # Первые 20
-        user_id, username, first_name, is_banned, created = user
-        status = "🚫" if is_banned else "✅"
-        username_str = f"@{username}" if username else "без юзернейма"
-        text += f"{status} <code>{user_id}</code> | {username_str}\n"
+    days = callback.data.split(":", 1)[1]
+    days = int(days) if days in ("1", "7", "30") else 7
+    symbols, by_type = await get_top_symbols(days)
     
-    if len(users) > 20:
-        text += f"\n... и ещё {len(users) - 20} юзеров"
+    text = f"🏆 <b>Топ за {days} дн.</b>\n\n"
+    if symbols:
+        text += "".join(f"{i}. {symbol}: <code>{count}</code>\n" for i, (symbol, count) in enumerate(symbols, 1))
+    else:
+        text += "Запросов пока нет\n"
+    if by_type:
+        text += "\n<b>По типам:</b>\n" + "".join(
+            f"• {request_type or '—'}: <code>{count}</code>\n" for request_type, count in by_type
+        )
+    text += f"\n<i>Топ обновляется раз в {REQUEST_MAINTENANCE_INTERVAL // 60} мин.</i>"
     
     kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=("• " if d == days else "") + label, callback_data=f"admin_top:{d}")
+         for d, label in ((1, "1 день"), (7, "7 дней"), (30, "30 дней"))],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
     ])
     await callback.message.edit_text(text, reply_markup=kb, parse_mode=ParseMode.HTML)
+    await callback.answer()
 
-@router.callback_query(F.data == "admin_download")
-async def cb_admin_download(callback: CallbackQuery):
+@router.callback_query(F.data == "admin_users")
+@router.callback_query(F.data.startswith("users:"))
+async def cb_admin_users(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         return await callback.answer("⛔ Нет доступа", show_alert=True)
     
-    users = await get_all_users()
+    # users:<фильтр>:<n|p>:<user_id курсора>
+    parts = callback.data.split(":")
+    flt, direction, cursor = parts[1:4] if len(parts) == 4 else ("all", "n", "")
+    if flt not in USER_FILTERS:
+        flt = "all"
+    forward = direction != "p"
+    cursor_id = int(cursor) if cursor.isdigit() else None
     
-    # Формируем txt
-    lines = ["user_id\tusername\tfirst_name\tis_banned\tcreated_at"]
+    users, has_prev, has_next = await get_users_page(flt, cursor_id, forward)
+    total = await count_users(flt)
+    
+    text = f"👥 <b>Пользователи</b> ({USER_FILTERS[flt][2]}: {total})\n\n"
     for user in users:
         user_id, username, first_name, is_banned, created = user
-        lines.append(f"{user_id}\t{username or '-'}\t{first_name or '-'}\t{is_banned}\t{created}")
+        status = "🚫" if is_banned else "✅"
+        username_str = f"@{username}" if username else "без юзернейма"
+        text += f"{status} <code>{user_id}</code> | {username_str}\n"
+    if not users:
+        text += "Никого нет"
     
-    content = "\n".join(lines)
+    buttons = [[
+        InlineKeyboardButton(
+            text=("• " if key == flt else "") + label,
+            callback_data=f"users:{key}:n:"
+        )
+        for key, (_, _, label) in USER_FILTERS.items()
+    ]]
+    nav = []
+    if has_prev and users:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"users:{flt}:p:{users[0][0]}"))
+    if has_next and users:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"users:{flt}:n:{users[-1][0]}"))
+    if nav:
+        buttons.append(nav)
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")])
     
-    file = BufferedInputFile(
-        content.encode("utf-8"),
-        filename=f"users_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-    )
+    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
+    await callback.message.edit_text(text, reply_markup=kb, parse_mode=ParseMode.HTML)
+    await callback.answer()
+
+@router.callback_query(F.data == "admin_download")
+async def cb_admin_download(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("⛔ Нет доступа", show_alert=True)
+    
+    spool, count = await export_users()
+    with spool:
+        file = SpooledInputFile(
+            spool,
+            filename=f"users_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        )
+        await callback.message.answer_document(file, caption=f"📄 Список юзеров: {count} шт.")
+    await callback.answer()
+
+@router.callback_query(F.data == "admin_download_requests")
+async def cb_admin_download_requests(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("⛔ Нет доступа", show_alert=True)
     
-    await callback.message.answer_document(file, caption=f"📄 Список юзеров: {len(users)} шт.")
+    spool, count = await export_requests()
+    with spool:
+        file = SpooledInputFile(
+            spool,
+            filename=f"requests_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv.gz"
+        )
+        await callback.message.answer_document(file, caption=f"📄 Лог запросов: {count} записей")
     await callback.answer()
 
 @router.callback_query(F.data == "admin_ban")
@@ -491,6 +3350,56 @@ async def cb_admin_unban(callback: CallbackQuery):
     )
     await callback.answer()
 
+@router.callback_query(F.data == "admin_broadcast")
+async def cb_admin_broadcast(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("⛔ Нет доступа", show_alert=True)
+    
+    await callback.message.edit_text(
+        "📢 <b>Рассылка</b>\n\n"
+        "Отправь <code>/broadcast текст</code> — покажу превью и спрошу подтверждение.\n"
+        f"Скорость: до {SEND_GLOBAL_RATE} сообщ./сек, забаненным и заблокировавшим бота не шлём.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
+        ]),
+        parse_mode=ParseMode.HTML
+    )
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("bc:"))
+async def cb_broadcast(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("⛔ Нет доступа", show_alert=True)
+    
+    _, action, broadcast_id = callback.data.split(":")
+    job = await get_broadcast(int(broadcast_id))
+    if job is None:
+        return await callback.answer("Рассылка не найдена", show_alert=True)
+    
+    if action == "start":
+        async with db_pool.reader() as db:
+            total = await _fetch_value(db, "SELECT COUNT(*) FROM users WHERE is_banned = 0 AND is_blocked = 0")
+        async with db_pool.writer() as db:
+            cursor = await db.execute(
+                "UPDATE broadcasts SET status = 'running', total = ?, chat_id = ?, message_id = ? "
+                "WHERE id = ? AND status = 'draft'",
+                (total, callback.message.chat.id, callback.message.message_id, job.id)
+            )
+            started = cursor.rowcount > 0
+        if not started:
+            return await callback.answer("Рассылка уже запущена или отменена")
+        if PROCESS_ROLE != "worker":
+            start_broadcast_task(job.id)
+        await callback.answer("🚀 Рассылка запущена")
+    elif action == "cancel":
+        if job.status not in ("draft", "running") or not await set_broadcast_status(job.id, "cancelled", job.status):
+            return await callback.answer("Рассылка уже завершена")
+        await callback.answer("⏹ Рассылка остановлена")
+    
+    job = await get_broadcast(job.id)
+    text, kb = format_broadcast(job)
+    await callback.message.edit_text(text, reply_markup=kb, parse_mode=ParseMode.HTML)
+
 @router.callback_query(F.data == "admin_back")
 async def cb_admin_back(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
@@ -507,6 +3416,7 @@ async def inline_handler(query: InlineQuery):
     
     text = query.query.strip().upper()
     results = []
+    cache_time = 60
     
     if not text:
         # Показываем популярные
@@ -523,17 +3433,63 @@ async def inline_handler(query: InlineQuery):
     else:
         await log_request(query.from_user.id, "inline", text)
         
-        # Ищем в крипте
-        if text.lower() in CRYPTO_IDS:
-            data = await get_crypto_prices([text])
-            formatted = format_crypto_price(data, text)
+        # Конвертация: "0.5 btc uah"
+        parsed = parse_convert(text)
+        conversion = format_conversion(*parsed) if parsed else None
+        if conversion:
+            amount, src, dst = parsed
             results.append(
                 InlineQueryResultArticle(
-                    id=f"crypto_{text}",
-                    title=f"💎 {text}",
-                    description="Нажми чтобы отправить курс",
+                    id=f"convert_{src}_{dst}",
+                    title=f"💱 {format_amount(amount)} {src} → {dst}",
+                    description=f"{format_amount(convert(amount, src, dst))} {dst}",
                     input_message_content=InputTextMessageContent(
-                        message_text=formatted,
+                        message_text=conversion,
+                        parse_mode=ParseMode.HTML
+                    )
+                )
+            )
+        elif parsed and rates_pending(parsed[1], parsed[2]):
+            amount, src, dst = parsed
+            results.append(
+                InlineQueryResultArticle(
+                    id=f"convert_{src}_{dst}",
+                    title=f"💱 {format_amount(amount)} {src} → {dst}",
+                    description="Курсы ещё загружаются, повтори запрос",
+                    input_message_content=InputTextMessageContent(
+                        message_text="⏳ Курсы ещё загружаются, попробуй через минуту"
+                    )
+                )
+            )
+            cache_time = 1
+        
+        # Ищем в каталоге монет: тикер, префикс, опечатки; цены — из снапшота
+        coins = coin_catalog.search(text, INLINE_MAX_RESULTS)
+        data = await inline_crypto_prices([coin_id for coin_id, _, _ in coins]) if coins else {}
+        for coin_id, symbol, name in coins:
+            if coin_id not in data:
+                results.append(
+                    InlineQueryResultArticle(
+                        id=f"crypto_{coin_id}"[:64],
+                        title=f"💎 {symbol.upper()} — {name}",
+                        description="Цена ещё загружается, повтори запрос",
+                        input_message_content=InputTextMessageContent(
+                            message_text=f"💎 <b>{symbol.upper()}</b>\nЦена пока недоступна",
+                            parse_mode=ParseMode.HTML
+                        )
+                    )
+                )
+                # Без цены — не даём Telegram закэшировать ответ надолго
+                cache_time = 1
+                continue
+            info = data[coin_id]
+            results.append(
+                InlineQueryResultArticle(
+                    id=f"crypto_{coin_id}"[:64],
+                    title=f"💎 {symbol.upper()} — {name}",
+                    description=f"${info.get('usd', 0):,.2f} · {info.get('usd_24h_change') or 0:+.2f}%",
+                    input_message_content=InputTextMessageContent(
+                        message_text=format_crypto_price(data, symbol, coin_id),
                         parse_mode=ParseMode.HTML
                     )
                 )
@@ -541,7 +3497,7 @@ async def inline_handler(query: InlineQuery):
         
         # Ищем в фиате
         if text in FIAT_CURRENCIES:
-            rates = await get_fiat_rates()
+            rates = await current_fiat_rates()
             formatted = format_fiat_rate(rates, text)
             results.append(
                 InlineQueryResultArticle(
@@ -568,7 +3524,7 @@ async def inline_handler(query: InlineQuery):
                 )
             )
     
-    await query.answer(results, cache_time=60)
+    await query.answer(results, cache_time=cache_time)
 
 # ============== ADMIN COMMANDS (text) ==============
 @router.message(F.text.regexp(r"^/ban\s+(\d+)$"))
@@ -589,11 +3545,358 @@ async def cmd_unban(message: Message):
     await unban_user(user_id)
     await message.answer(f"✅ Пользователь <code>{user_id}</code> разбанен", parse_mode=ParseMode.HTML)
 
+# ============== МОНИТОРИНГ ==============
+async def handler_metrics(handler, event, data: dict):
+    """Внутренний middleware: время и ошибки по каждому хендлеру"""
+    name = (("handler", data["handler"].callback.__name__),)
+    start = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        metrics.inc("bot_handler_errors_total", name)
+        raise
+    finally:
+        metrics.observe("bot_handler_seconds", name, time.perf_counter() - start)
+
+async def api_metrics(make_request, bot: Bot, method):
+    """Middleware сессии бота: время каждого вызова Bot API"""
+    name = (("method", type(method).__name__),)
+    start = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception as e:
+        metrics.inc("bot_api_errors_total", name + (("error", type(e).__name__),))
+        raise
+    finally:
+        metrics.observe("bot_api_seconds", name, time.perf_counter() - start)
+
+for observer in (router.message, router.callback_query, router.inline_query):
+    observer.middleware(handler_metrics)
+bot.session.middleware(api_metrics)
+
+metrics.describe("bot_handler_seconds", "Handler latency")
+metrics.describe("bot_handler_errors_total", "Unhandled handler exceptions")
+metrics.describe("bot_upstream_seconds", "Upstream API request latency")
+metrics.describe("bot_upstream_requests_total", "Upstream API requests by status")
+metrics.describe("bot_db_seconds", "Database helper latency")
+metrics.describe("bot_db_wait_seconds", "Time waiting for a database connection")
+metrics.describe("bot_api_seconds", "Bot API call latency")
+metrics.describe("bot_api_errors_total", "Bot API errors")
+metrics.describe("bot_provider_requests_total", "Price provider requests by result")
+metrics.describe("bot_provider_hedges_total", "Hedged requests sent to a fallback provider")
+metrics.collect("bot_provider_up", "gauge", lambda: {
+    (("provider", name),): int(provider.available()) for name, provider in PROVIDERS.items()
+}, "1 if the provider's circuit breaker is closed")
+metrics.collect("bot_price_cache_lookups_total", "counter", lambda: {
+    (("result", key),): value for key, value in price_cache.stats().items()
+    if key in ("hits", "stale_hits", "misses", "coalesced")
+}, "Price cache lookups by result")
+metrics.collect("bot_price_card_renders_total", "counter", lambda: {
+    (("result", "hit"),): render_cache.hits,
+    (("result", "miss"),): render_cache.misses,
+}, "Price card render cache lookups by result")
+metrics.collect("bot_price_card_refreshes_total", "counter", lambda: {
+    (("result", "edited"),): message_renders.edited,
+    (("result", "unchanged"),): message_renders.unchanged,
+    (("result", "debounced"),): message_renders.debounced,
+}, "Price card taps by result")
+metrics.collect("bot_request_log_queue", "gauge", lambda: request_log.queue.qsize(), "Request log records waiting")
+metrics.collect("bot_request_log_records_total", "counter", lambda: {
+    (("result", "written"),): request_log.written,
+    (("result", "dropped"),): request_log.dropped,
+    (("result", "failed"),): request_log.failed,
+}, "Request log records by result")
+metrics.collect("bot_send_inflight", "gauge", lambda: len(sender.tasks), "Background sends in flight")
+metrics.collect("bot_sent_messages_total", "counter", lambda: {
+    (("result", "sent"),): sender.sent,
+    (("result", "failed"),): sender.failed,
+    (("result", "blocked"),): sender.blocked,
+    (("result", "retried"),): sender.retried,
+}, "Scheduler sends by result")
+metrics.collect("bot_throttled_total", "counter", lambda: throttling.rejected, "Updates rejected by throttling")
+metrics.collect("bot_throttle_buckets", "gauge", lambda: len(throttling.buckets), "Throttling buckets in memory")
+metrics.collect("bot_alerts", "gauge", lambda: len(alert_index.alerts), "Alerts in the in-memory index")
+metrics.collect("bot_price_snapshot_age_seconds", "gauge",
+                lambda: time.time() - get_snapshot().updated_at if get_snapshot().version else -1,
+                "Seconds since the last price snapshot")
+
+metrics_runner: Optional[web.AppRunner] = None
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server():
+    global metrics_runner
+    if not METRICS_PORT:
+        return
+    port = METRICS_PORT + (1 + WORKER_INDEX if PROCESS_ROLE == "worker" else 0)
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_endpoint)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    try:
+        await web.TCPSite(metrics_runner, METRICS_HOST, port).start()
+    except OSError as e:
+        logging.warning("Metrics endpoint disabled, port %d: %r", port, e)
+        await metrics_runner.cleanup()
+        metrics_runner = None
+        return
+    logging.info("Metrics on http://%s:%d/metrics", METRICS_HOST, port)
+
+async def stop_metrics_server():
+    global metrics_runner
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+# ============== WEBHOOK ==============
+class WebhookServer:
+    """Приём апдейтов по HTTP: проверка секрета, сразу 200, обработка с лимитом параллельности"""
+
+    def __init__(self, max_concurrency: int = WEBHOOK_MAX_CONCURRENCY, max_backlog: int = WEBHOOK_MAX_BACKLOG):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_backlog = max_backlog
+        self.tasks: set[asyncio.Task] = set()
+        self.accepting = True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        if not self.accepting:
+            # Telegram повторит доставку (возможно, на другой инстанс)
+            return web.Response(status=503)
+        if len(self.tasks) >= self.max_backlog:
+            # Очередь полна — не копим задачи в памяти, Telegram повторит позже
+            return web.Response(status=503)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception:
+            return web.Response(status=400)
+        
+        task = asyncio.create_task(self._process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: Update):
+        async with self.semaphore:
+            try:
+                await dp.feed_update(bot, update)
+            except Exception:
+                logging.exception("Failed to process update %s", update.update_id)
+
+    async def drain(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Перестать принимать апдейты и дождаться уже принятых"""
+        self.accepting = False
+        if self.tasks:
+            logging.info("Draining %d in-flight updates", len(self.tasks))
+            _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+            for task in pending:
+                task.cancel()
+
+def _stop_event() -> asyncio.Event:
+    """Событие, которое выставляют SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    return stop
+
 # ============== ЗАПУСК ==============
-async def main():
+background_tasks: list[asyncio.Task] = []
+
+# "single" — обычный запуск, "fetcher" — загрузчик цен, "worker" — обработчик апдейтов
+PROCESS_ROLE = "single"
+WORKER_INDEX = 0
+
+async def fetch_bot_username():
+    """Фоновая задача: узнать имя бота для подсказок; Bot API недоступен — пробуем позже"""
+    global bot_username
+    delay = BOT_USERNAME_RETRY
+    while True:
+        try:
+            bot_username = (await asyncio.wait_for(bot.me(), HTTP_TOTAL_TIMEOUT)).username
+            return
+        except Exception as e:
+            logging.warning("Failed to get bot username, retrying in %ds: %r", delay, e)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, BOT_USERNAME_MAX_RETRY)
+
+async def on_startup():
     await init_db()
-    logging.info("Bot started")
+    request_log.start()
+    await load_catalog()
+    await init_http()
+    await start_metrics_server()
+    if PROCESS_ROLE != "single":
+        attach_shared_snapshot(writable=PROCESS_ROLE == "fetcher")
+    if PROCESS_ROLE != "fetcher":
+        background_tasks.append(asyncio.create_task(fetch_bot_username()))
+    
+    if PROCESS_ROLE == "worker":
+        # Цены и каталог обновляет загрузчик, воркер только читает
+        background_tasks.append(asyncio.create_task(worker_sync()))
+    else:
+        # До запуска обновления: отвечаем ценами с диска, пока не придут свежие
+        await load_saved_snapshot()
+        await price_history.load_open()
+        await load_alerts()
+        snapshot_listeners.append(price_history.append)
+        snapshot_listeners.append(check_alerts)
+        if PROCESS_ROLE == "fetcher":
+            background_tasks.append(asyncio.create_task(alert_sync()))
+            background_tasks.append(asyncio.create_task(broadcast_sync()))
+        background_tasks.append(asyncio.create_task(price_refresher()))
+        background_tasks.append(asyncio.create_task(catalog_refresher()))
+        background_tasks.append(asyncio.create_task(history_maintainer()))
+        background_tasks.append(asyncio.create_task(snapshot_saver()))
+        background_tasks.append(asyncio.create_task(request_log_maintainer()))
+        await resume_broadcasts()
+
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    # Сработавшие алерты уже удалены из БД — даём уведомлениям дойти
+    if alert_tasks:
+        await asyncio.wait(alert_tasks, timeout=ALERT_SHUTDOWN_TIMEOUT)
+    for task in list(alert_tasks) + list(sender.tasks):
+        task.cancel()
+    await asyncio.gather(*alert_tasks, *sender.tasks, return_exceptions=True)
+    if PROCESS_ROLE != "worker":
+        await price_history.flush()
+        await save_snapshot()
+    await request_log.stop()
+    await stop_metrics_server()
+    await close_http()
+    await close_db()
+
+def _mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+async def worker_sync():
+    """Воркер: подтягивает баны и каталог монет, которые меняют другие процессы"""
+    catalog_mtime = _mtime(COINS_CATALOG_PATH)
+    while True:
+        await asyncio.sleep(WORKER_SYNC_INTERVAL)
+        try:
+            await user_registry.reload_bans()
+            mtime = _mtime(COINS_CATALOG_PATH)
+            if mtime != catalog_mtime:
+                catalog_mtime = mtime
+                await load_catalog()
+        except Exception:
+            logging.exception("Worker sync failed")
+
+async def run_webhook():
+    server = WebhookServer()
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, server.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # Воркеры слушают один порт, ядро раздаёт соединения (SO_REUSEPORT)
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=PROCESS_ROLE == "worker")
+    
+    stop = _stop_event()
+    await site.start()
+    logging.info("Webhook server listening on %s:%d%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    if WEBHOOK_URL and WORKER_INDEX == 0:
+        await bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(WEBHOOK_MAX_CONCURRENCY, 100)
+        )
+    
+    try:
+        await stop.wait()
+    finally:
+        await server.drain()
+        await runner.cleanup()
+        await bot.session.close()
+
+async def run_polling():
+    # Если раньше стоял webhook, getUpdates вернёт конфликт
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
+async def main(mode: str = BOT_MODE):
+    await on_startup()
+    logging.info("Bot started (%s, %s)", mode, PROCESS_ROLE)
+    try:
+        if PROCESS_ROLE == "fetcher":
+            await _stop_event().wait()
+        elif mode == "webhook":
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        await on_shutdown()
+
+def run_process(role: str, index: int, mode: str):
+    """Точка входа дочернего процесса"""
+    global PROCESS_ROLE, WORKER_INDEX
+    PROCESS_ROLE, WORKER_INDEX = role, index
+    # Обработчики сигналов супервизора не наследуем
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    try:
+        asyncio.run(main(mode))
+    except KeyboardInterrupt:
+        pass
+
+def run_supervisor(workers: int, mode: str):
+    """Запустить загрузчик цен и N воркеров, перезапускать упавших, по сигналу — остановить всех"""
+    SharedSnapshot.create(SHARED_SNAPSHOT_PATH)
+    asyncio.run(prepare_db())
+    stopping = False
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    
+    def spawn(role: str, index: int) -> multiprocessing.Process:
+        proc = multiprocessing.Process(
+            target=run_process, args=(role, index, mode), name=f"{role}-{index}"
+        )
+        proc.start()
+        return proc
+    
+    specs = [("fetcher", 0)] + [("worker", i) for i in range(workers)]
+    procs = {spec: spawn(*spec) for spec in specs}
+    logging.info("Supervisor started: 1 fetcher, %d workers", workers)
+    
+    while not stopping:
+        time.sleep(1)
+        for spec, proc in procs.items():
+            if not proc.is_alive() and not stopping:
+                logging.warning("%s exited with code %s, restarting", proc.name, proc.exitcode)
+                procs[spec] = spawn(*spec)
+    
+    for proc in procs.values():
+        if proc.is_alive():
+            proc.terminate()
+    for proc in procs.values():
+        proc.join(WEBHOOK_DRAIN_TIMEOUT + 10)
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Crypto & fiat rate Telegram bot")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default=BOT_MODE)
+    parser.add_argument("--workers", type=int, default=BOT_WORKERS,
+                        help="запустить N процессов-воркеров и отдельный загрузчик цен (только webhook)")
+    args = parser.parse_args()
+    if args.workers > 0:
+        if args.mode != "webhook":
+            parser.error("--workers requires --mode webhook: polling can't be shared between processes")
+        run_supervisor(args.workers, args.mode)
+    else:
+        asyncio.run(main(args.mode))